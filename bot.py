@@ -1,14 +1,31 @@
 # bot.py
 import asyncio
+import base64
+import functools
+import heapq
+import html
+import itertools
+import multiprocessing
 import os
 import random
 import re
 import shutil
+import subprocess
+import sys
 import time
+import traceback
 import uuid
-from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
-
+from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Dict, Any, Hashable, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TTLCache
 from pyrogram import Client, filters, enums, idle
 from pyrogram.types import (
     Message,
@@ -16,20 +33,27 @@ from pyrogram.types import (
     InlineKeyboardButton,
     CallbackQuery,
     Chat,
+    User,
 )
-from pyrogram.errors import MessageNotModified
+from pyrogram.errors import FloodWait
 
 from config import Config
 from database import (
-    get_or_create_user,
+    USE_DB,
+    ensure_user,
     is_banned,
+    load_banned_ids,
+    reload_banned_ids,
+    set_premium_until,
+    load_premium_until,
     set_ban,
     count_users,
-    get_all_users,
+    get_all_users_iter,
     register_temp_path,
     update_user_stats,
 )
-from utils.progress import progress_for_pyrogram, human_bytes
+from utils.progress import progress_for_pyrogram, human_bytes, safe_edit, settle_progress
+from utils.tg_downloader import download_tg_file
 from utils.extractors import extract_archive, detect_encrypted
 from utils.link_parser import (
     find_links_in_text,
@@ -39,28 +63,83 @@ from utils.link_parser import (
 from utils.cleanup import cleanup_worker
 from utils.media_tools import extract_audio, generate_thumbnail
 from utils.http_downloader import download_file
-from utils.m3u8_tools import get_m3u8_variants, download_m3u8_stream
+from utils.m3u8_tools import (
+    get_m3u8_variants,
+    prefetch_media_playlists,
+    download_m3u8_stream,
+)
 from utils.gdrive import get_gdrive_direct_link
 
 
 # ----------------- Pyrogram client -----------------
 
-app = Client(
-    "serena_unzip_bot",
-    api_id=Config.API_ID,
-    api_hash=Config.API_HASH,
-    bot_token=Config.BOT_TOKEN,
-    in_memory=True,
-)
+def make_app(shard_id: int = 0) -> Client:
+    # har shard ka apna session name -> alag MTProto connection pool
+    name = "serena_unzip_bot" if Config.SHARDS <= 1 else f"serena_unzip_bot_{shard_id}"
+    # persistent session file: restart pe bot login RPC / auth key exchange bach jata hai
+    os.makedirs(Config.SESSION_DIR, exist_ok=True)
+    return Client(
+        name,
+        api_id=Config.API_ID,
+        api_hash=Config.API_HASH,
+        bot_token=Config.BOT_TOKEN,
+        workdir=Config.SESSION_DIR,
+        max_concurrent_transmissions=Config.MAX_CONCURRENT_TRANSMISSIONS,
+        sleep_threshold=Config.SLEEP_THRESHOLD,
+    )
 
-# in‑memory state
-user_locks: Dict[int, asyncio.Lock] = {}
-tasks: Dict[str, Dict[str, Any]] = {}        # unzip tasks & meta
-pending_password: Dict[int, Dict[str, Any]] = {}
-user_cancelled: Dict[int, bool] = {}
-M3U8_TASKS: Dict[str, Dict[str, Any]] = {}    # quality select tasks
 
-VIDEO_EXT_SET = {".mp4", ".mkv", ".mov", ".avi", ".webm", ".ts"}
+app = make_app(Config.SHARD_ID)
+
+# in‑memory state
+user_locks: "OrderedDict[Hashable, asyncio.Lock]" = OrderedDict()  # LRU, capped by MAX_USER_LOCKS
+# abandoned flows leak na karein: TTL = temp files ka cleanup horizon
+SESSION_TTL_SEC = Config.AUTO_DELETE_DEFAULT_MIN * 60
+
+
+# task state: slots dataclass (per-entry dict nahi), TTLCache se bounded + expire
+@dataclass(slots=True)
+class UnzipTask:
+    user_id: int
+    base_dir: str
+    files: List[str]
+    is_video: List[bool]  # files ke parallel: task banate waqt ek baar classify
+    archive_name: str
+
+
+@dataclass(slots=True)
+class M3U8Task:
+    user_id: int
+    variants: List[Dict[str, str]]
+    temp_root: str
+    base_name: str
+
+
+tasks: "TTLCache[str, UnzipTask]" = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SEC)  # unzip tasks & meta
+pending_password: "TTLCache[int, Dict[str, Any]]" = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SEC)
+user_cancelled: "TTLCache[int, bool]" = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SEC)  # sirf cancelled ids
+M3U8_TASKS: "TTLCache[str, M3U8Task]" = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SEC)  # quality select tasks
+
+# Telegram limits: ~30 msg/s global, ~1 msg/s per chat
+UPLOAD_CONCURRENCY = 3  # send_all parallel uploads per task
+BROADCAST_CONCURRENCY = 30
+BROADCAST_BATCH = 500
+broadcast_limiter = AsyncLimiter(30, 1)
+chat_limiters: "OrderedDict[int, AsyncLimiter]" = OrderedDict()  # LRU, capped
+MAX_CHAT_LIMITERS = 4096
+upload_limiters: "OrderedDict[int, AsyncLimiter]" = OrderedDict()  # per-chat media sends
+UPLOAD_RATE_PER_MIN = 20
+HEAVY_SEM = asyncio.Semaphore(Config.MAX_HEAVY_JOBS)  # global cap on heavy downloads
+
+# per-chat FIFO job queues (chat A ka slow kaam chat B ko block na kare)
+chat_queues: Dict[int, asyncio.Queue] = {}
+chat_workers: Dict[int, asyncio.Task] = {}
+
+REPLACE_SPLIT_RE = re.compile(r"->|=>")  # settings "replace" rule: old -> new
+
+VIDEO_EXT_SET = frozenset({".mp4", ".mkv", ".mov", ".avi", ".webm", ".ts"})
+TXT_IN_MEMORY_MAX = 8 * 1024 * 1024  # is se chhoti TXT disk pe nahi utarti
+ARCHIVE_EXTS = frozenset({".zip", ".rar", ".7z", ".tar", ".gz", ".tgz"})  # .tar.gz -> ".gz"
 
 EMOJI_LIST = [
     "🚀",
@@ -77,53 +156,307 @@ EMOJI_LIST = [
 
 # premium + caption settings
 premium_until: Dict[int, float] = {}  # user_id -> timestamp until premium
-user_caption_settings: Dict[int, Dict[str, Any]] = {}  # user_id -> {base, counter, rfrom, rto, updated_at}
-pending_settings_action: Dict[int, str] = {}  # user_id -> "caption" | "replace"
+premium_heap: List[Tuple[float, int]] = []  # (expiry, user_id) min-heap for clock_worker
+# user_id -> {base, counter, rfrom, rto, updated_at}; LRU bounded (non-premium TTL get_caption_cfg me)
+user_caption_settings: "LRUCache[int, Dict[str, Any]]" = LRUCache(maxsize=10_000)
+pending_settings_action: "TTLCache[int, str]" = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SEC)  # "caption" | "replace"
 
 # thumbnail mode per user: 'original' or 'random'
-user_thumb_mode: Dict[int, str] = {}  # user_id -> mode
+user_thumb_mode: "LRUCache[int, str]" = LRUCache(maxsize=10_000)  # user_id -> mode
+
+# archive extraction worker processes. forkserver: workers running loop +
+# threads (to_thread, Pyrogram) wale process se fork nahi hote.
+# Windows / forkserver-less platforms pe spawn (local `python bot.py` bhi chale)
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _EXTRACT_CTX = multiprocessing.get_context("forkserver")
+    _EXTRACT_CTX.set_forkserver_preload(["utils.extractors", "utils.link_parser"])
+else:
+    _EXTRACT_CTX = multiprocessing.get_context("spawn")
+EXTRACT_POOL = ProcessPoolExecutor(
+    max_workers=Config.EXTRACT_WORKERS, mp_context=_EXTRACT_CTX
+)
+# pool jitne hi slots: queue pool ke andar nahi, yahin wait ho (disk pressure bhi capped)
+EXTRACT_SEM = asyncio.Semaphore(Config.EXTRACT_WORKERS)
+
+# shared HTTP pool (keep-alive + DNS cache) for all link downloads
+HTTP_SESSION: Optional[aiohttp.ClientSession] = None
 
 # link sessions (for TXT + messages): (chat_id, msg_id) -> {links, content}
-LINK_SESSIONS: Dict[Tuple[int, int], Dict[str, Any]] = {}
+LINK_SESSIONS: "TTLCache[Tuple[int, int], Dict[str, Any]]" = TTLCache(
+    maxsize=2000, ttl=3600
+)
 
 
-def get_lock(user_id: int) -> asyncio.Lock:
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    return user_locks[user_id]
+def get_lock(key: Hashable) -> asyncio.Lock:
+    # key: user_id (download/task lock) ya ("extract", user_id)
+    lock = user_locks.get(key)
+    if lock is not None:
+        user_locks.move_to_end(key)
+        return lock
 
+    lock = asyncio.Lock()
+    user_locks[key] = lock
 
-def is_owner(user_id: int) -> bool:
-    return user_id in Config.OWNER_IDS
+    # LRU eviction: sabse purane free locks hatao, running task wale lock skip
+    while len(user_locks) > Config.MAX_USER_LOCKS:
+        victim = next(
+            (uid for uid, l in user_locks.items() if not l.locked()), None
+        )
+        if victim is None or victim == key:
+            break
+        del user_locks[victim]
+
+    return lock
+
+
+async def _chat_worker(chat_id: int, q: asyncio.Queue):
+    while True:
+        try:
+            job = await asyncio.wait_for(q.get(), timeout=Config.CHAT_WORKER_IDLE_SEC)
+        except asyncio.TimeoutError:
+            if q.empty():
+                break
+            continue
+        try:
+            await job()
+        except Exception as e:
+            # queue chalti rahe, par error chupchap gum na ho
+            print(f"[chat {chat_id}] handler error: {e!r}")
+            traceback.print_exc()
+
+    # idle worker -> queue + task hata do, memory bounded rahe
+    if chat_queues.get(chat_id) is q:
+        chat_queues.pop(chat_id, None)
+        chat_workers.pop(chat_id, None)
+
+
+def enqueue_chat_job(chat_id: int, job):
+    q = chat_queues.get(chat_id)
+    if q is None:
+        q = asyncio.Queue()
+        chat_queues[chat_id] = q
+        chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id, q))
+    q.put_nowait(job)
+
+
+def per_chat_queue(func):
+    """
+    Handler ko chat ki FIFO queue me daal deta hai: same chat me order
+    preserve, alag chats parallel chalti hain.
+    """
+    @functools.wraps(func)
+    async def wrapper(client: Client, message: Message):
+        enqueue_chat_job(message.chat.id, lambda: func(client, message))
 
+    return wrapper
 
-def is_video_path(path: str) -> bool:
-    return Path(path).suffix.lower() in VIDEO_EXT_SET
+
+def get_chat_limiter(chat_id: int) -> AsyncLimiter:
+    limiter = chat_limiters.get(chat_id)
+    if limiter is not None:
+        chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    limiter = AsyncLimiter(1, 1)
+    chat_limiters[chat_id] = limiter
+    if len(chat_limiters) > MAX_CHAT_LIMITERS:
+        chat_limiters.popitem(last=False)
+    return limiter
+
+
+def get_upload_limiter(chat_id: int) -> AsyncLimiter:
+    # ~20 media sends/min per chat; sirf limit cross hone pe hi wait
+    limiter = upload_limiters.get(chat_id)
+    if limiter is not None:
+        upload_limiters.move_to_end(chat_id)
+        return limiter
+
+    limiter = AsyncLimiter(UPLOAD_RATE_PER_MIN, 60)
+    upload_limiters[chat_id] = limiter
+    if len(upload_limiters) > MAX_CHAT_LIMITERS:
+        upload_limiters.popitem(last=False)
+    return limiter
+
+
+_OWNER_SET = frozenset(Config.OWNER_IDS)
+
+
+def message_content(m: Message) -> str:
+    return (m.text or m.caption or "").strip()
+
+
+# per-link file names ke liye sasta id (temp_root already uuid se unique hai)
+_id_counter = itertools.count()
+
+
+def short_id() -> str:
+    return f"{next(_id_counter):x}"
+
+
+def new_task_id() -> str:
+    # uuid4 ke 16 bytes base64url me: 22 chars (hex ke 32 ki jagah), callback_data 64 byte cap
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b"=").decode("ascii")
+
+
+# per-user parent dir ek baar banao; steady state me sirf uuid dir ka ek mkdir
+_user_dirs_ready: Set[int] = set()
+
+
+def new_temp_root(user_id: int) -> Path:
+    user_dir = Path(Config.TEMP_DIR) / str(user_id)
+    if user_id not in _user_dirs_ready:
+        user_dir.mkdir(parents=True, exist_ok=True)
+        _user_dirs_ready.add(user_id)
+    temp_root = user_dir / uuid.uuid4().hex
+    try:
+        os.mkdir(temp_root)
+    except FileNotFoundError:
+        # parent bahar se delete ho gaya (manual cleanup) -> dobara banao
+        temp_root.mkdir(parents=True, exist_ok=True)
+    return temp_root
+
+
+def is_owner(user_id: int) -> bool:
+    return user_id in _OWNER_SET
 
 
 def random_emoji() -> str:
     return random.choice(EMOJI_LIST)
 
 
+def emojis(n: int) -> List[str]:
+    # ek PRNG call me n emojis
+    return random.choices(EMOJI_LIST, k=n)
+
+
+# coarse clock: har second refresh hota hai, per-message time.time() se bachne ke liye
+_NOW: float = time.time()
+
+
+async def clock_worker():
+    global _NOW
+    while True:
+        _NOW = time.time()
+        # expired premium entries heap se pop karo
+        while premium_heap and premium_heap[0][0] <= _NOW:
+            exp, uid = heapq.heappop(premium_heap)
+            if premium_until.get(uid) == exp:  # re-grant wale stale entries skip
+                premium_until.pop(uid, None)
+        await asyncio.sleep(1)
+
+
+def grant_premium(user_id: int, until: float):
+    premium_until[user_id] = until
+    heapq.heappush(premium_heap, (until, user_id))
+
+
 def is_premium_user(user_id: int) -> bool:
-    t = premium_until.get(user_id)
-    if not t:
-        return False
-    if t < time.time():
-        premium_until.pop(user_id, None)
-        return False
-    return True
+    return premium_until.get(user_id, 0) >= _NOW
 
 
 def get_thumb_mode(user_id: int) -> str:
     return user_thumb_mode.get(user_id, "random")
 
 
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Shared session; startup se pehle / close ke baad call hua to lazily
+    naya bana deta hai (har call pe temporary session kabhi nahi).
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=16,  # 2 parallel m3u8 streams same CDN pe
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            ),
+            # total nahi (lambe downloads), par stalled CDN pe connect/read timeout zaroor
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60),
+        )
+    return HTTP_SESSION
+
+
+async def start_http_session() -> aiohttp.ClientSession:
+    return get_http_session()
+
+
+async def close_http_session():
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+
+async def shutdown_resources():
+    await close_http_session()
+    EXTRACT_POOL.shutdown(wait=False, cancel_futures=True)
+
+
 # ----------------- logging helpers (per user, with topics if available) -----------------
 
+# best-effort log jobs: bounded queue + background workers (user reply wait na kare)
+LOG_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=10000)
+LOG_WORKERS = 4
+
+
+async def log_worker():
+    while True:
+        fn, args = await LOG_QUEUE.get()
+        try:
+            await fn(*args)
+        except Exception:
+            pass
+
+
+# fire-and-forget tasks ka strong ref, warna GC beech me task gira sakta hai
+_BG_TASKS: Set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+
+def _loop_exception_handler(loop: asyncio.AbstractEventLoop, context: Dict[str, Any]):
+    # background task ka unhandled error chupchap gum na ho
+    exc = context.get("exception")
+    print(f"[loop] {context.get('message', '')}: {exc!r}" if exc else f"[loop] {context}")
+
+
+def start_background_tasks():
+    asyncio.get_running_loop().set_exception_handler(_loop_exception_handler)
+    spawn(clock_worker())
+    if Config.LOG_CHANNEL_ID:
+        for _ in range(LOG_WORKERS):
+            spawn(log_worker())
+    for _ in range(UPLOAD_WORKERS):
+        spawn(upload_worker())
+
+
+if Config.LOG_CHANNEL_ID:
+
+    def enqueue_log(fn, *args):
+        try:
+            LOG_QUEUE.put_nowait((fn, args))
+        except asyncio.QueueFull:
+            pass  # logging best-effort hai, drop kar do
+
+else:
+
+    def enqueue_log(fn, *args):
+        # logging band: queue / worker wakeup ka kharcha hi nahi
+        return
+
+
 log_chat_info: Optional[Chat] = None
 log_is_forum: bool = False
+_LOG_CHAT_LOCK = asyncio.Lock()  # concurrent first callers pe ek hi get_chat
 user_log_topics: Dict[int, int] = {}  # user_id -> root_msg_id (topic root message id)
+_LOG_TOPIC_INFLIGHT: Dict[int, asyncio.Task] = {}  # user_id -> topic create (single-flight)
 
 
 async def get_log_chat_info(client: Client) -> Tuple[Optional[Chat], bool]:
@@ -134,17 +467,35 @@ async def get_log_chat_info(client: Client) -> Tuple[Optional[Chat], bool]:
     if log_chat_info is not None:
         return log_chat_info, log_is_forum
 
-    try:
-        chat = await client.get_chat(Config.LOG_CHANNEL_ID)
-        log_chat_info = chat
-        log_is_forum = bool(getattr(chat, "is_forum", False))
-    except Exception:
-        log_chat_info = None
-        log_is_forum = False
+    async with _LOG_CHAT_LOCK:
+        if log_chat_info is not None:
+            return log_chat_info, log_is_forum
+        try:
+            chat = await client.get_chat(Config.LOG_CHANNEL_ID)
+            log_chat_info = chat
+            log_is_forum = bool(getattr(chat, "is_forum", False))
+        except Exception:
+            log_chat_info = None
+            log_is_forum = False
 
     return log_chat_info, log_is_forum
 
 
+def cached_user_log_target(user_id: int) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Sync fast path: agar log chat (aur forum topic) pehle se resolve hai to
+    (chat_id, root_msg_id) seedha return, warna None (tab await path lo).
+    """
+    if log_chat_info is None:
+        return None
+    if not log_is_forum:
+        return log_chat_info.id, None
+    root_msg_id = user_log_topics.get(user_id)
+    if root_msg_id is None:
+        return None
+    return log_chat_info.id, root_msg_id
+
+
 async def get_user_log_target(client: Client, user) -> Tuple[Optional[int], Optional[int]]:
     """
     Returns (chat_id, root_msg_id or None).
@@ -173,6 +524,20 @@ async def get_user_log_target(client: Client, user) -> Tuple[Optional[int], Opti
         # old pyrogram – topic API may not exist
         return chat_id, None
 
+    # INPUT + OUTPUT log jobs alag workers pe saath aate hain: topic ek hi bane
+    uid = user.id
+    task = _LOG_TOPIC_INFLIGHT.get(uid)
+    if task is None:
+        task = asyncio.create_task(_create_user_topic(client, chat_id, user))
+        _LOG_TOPIC_INFLIGHT[uid] = task
+        task.add_done_callback(lambda _t: _LOG_TOPIC_INFLIGHT.pop(uid, None))
+    root_msg_id = await asyncio.shield(task)
+
+    # None -> fallback: no topic support
+    return chat_id, root_msg_id
+
+
+async def _create_user_topic(client: Client, chat_id: int, user) -> Optional[int]:
     root_msg_id = None
     name = f"{user.first_name or 'User'} | {user.id}"
     try:
@@ -183,8 +548,7 @@ async def get_user_log_target(client: Client, user) -> Tuple[Optional[int], Opti
         root_msg_id = None
 
     if root_msg_id is None:
-        # fallback: no topic support
-        return chat_id, None
+        return None
 
     user_log_topics[user.id] = root_msg_id
 
@@ -200,122 +564,108 @@ async def get_user_log_target(client: Client, user) -> Tuple[Optional[int], Opti
     except Exception:
         pass
 
-    return chat_id, root_msg_id
+    return root_msg_id
 
 
-async def log_user_input(client: Client, message: Message, context: str):
-    if not Config.LOG_CHANNEL_ID:
-        return
-    user = message.from_user
-    if not user:
-        return
+_log_prefix_cache: "OrderedDict[int, Tuple[str, str, str]]" = OrderedDict()
+LOG_PREFIX_CACHE_MAX = 4096
 
-    chat_id, root_msg_id = await get_user_log_target(client, user)
-    if not chat_id:
-        return
 
-    cap = (
-        f"🔹 <b>INPUT</b>\n"
-        f"• User: <b>{user.first_name or ''}</b> (@{user.username or 'N/A'})\n"
-        f"• ID: <code>{user.id}</code>\n"
-        f"• Context: <code>{context}</code>"
+def log_user_prefix(user) -> str:
+    """
+    Cached, HTML-escaped "User / ID" lines for log captions.
+    Name/username change ho to entry rebuild ho jati hai.
+    """
+    first = user.first_name or ""
+    uname = user.username or "N/A"
+    hit = _log_prefix_cache.get(user.id)
+    if hit is not None and hit[0] == first and hit[1] == uname:
+        _log_prefix_cache.move_to_end(user.id)
+        return hit[2]
+
+    prefix = (
+        f"• User: <b>{html.escape(first)}</b> (@{html.escape(uname)})\n"
+        f"• ID: <code>{user.id}</code>"
     )
-    if message.caption:
-        cap += f"\n\n{message.caption}"
+    _log_prefix_cache[user.id] = (first, uname, prefix)
+    if len(_log_prefix_cache) > LOG_PREFIX_CACHE_MAX:
+        _log_prefix_cache.popitem(last=False)
+    return prefix
+
+
+# media type -> Client method used to re-send it by file_id
+LOG_MEDIA_SENDERS = (
+    ("document", "send_document"),
+    ("video", "send_video"),
+    ("photo", "send_photo"),
+    ("audio", "send_audio"),
+)
+
+
+async def _send_log(
+    client: Client, chat_id: int, root_msg_id: Optional[int], msg: Message, cap: str
+):
+    kw = {"reply_to_message_id": root_msg_id} if root_msg_id else {}
 
     # text log
     try:
-        if root_msg_id:
-            await client.send_message(chat_id, cap, reply_to_message_id=root_msg_id)
-        else:
-            await client.send_message(chat_id, cap)
+        await client.send_message(chat_id, cap, **kw)
     except Exception:
         pass
 
     # media log by re-sending file_id
+    for attr, method in LOG_MEDIA_SENDERS:
+        media = getattr(msg, attr, None)
+        if media:
+            break
+    else:
+        return
+
     try:
-        if message.document:
-            fid = message.document.file_id
-            if root_msg_id:
-                await client.send_document(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_document(chat_id, fid, caption=cap)
-        elif message.video:
-            fid = message.video.file_id
-            if root_msg_id:
-                await client.send_video(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_video(chat_id, fid, caption=cap)
-        elif message.photo:
-            fid = message.photo.file_id
-            if root_msg_id:
-                await client.send_photo(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_photo(chat_id, fid, caption=cap)
-        elif message.audio:
-            fid = message.audio.file_id
-            if root_msg_id:
-                await client.send_audio(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_audio(chat_id, fid, caption=cap)
+        await getattr(client, method)(chat_id, media.file_id, caption=cap, **kw)
     except Exception:
         pass
 
 
+async def log_user_input(client: Client, message: Message, context: str):
+    if not Config.LOG_CHANNEL_ID:
+        return
+    user = message.from_user
+    if not user:
+        return
+
+    target = cached_user_log_target(user.id)
+    if target is None:
+        target = await get_user_log_target(client, user)
+    chat_id, root_msg_id = target
+    if not chat_id:
+        return
+
+    parts = ["🔹 <b>INPUT</b>\n", log_user_prefix(user), "\n• Context: <code>", context, "</code>"]
+    if message.caption:
+        parts += ("\n\n", message.caption)
+    cap = "".join(parts)
+
+    await _send_log(client, chat_id, root_msg_id, message, cap)
+
+
 async def log_user_output(client: Client, user, msg: Message, context: str):
     if not Config.LOG_CHANNEL_ID or not user or not msg:
         return
 
-    chat_id, root_msg_id = await get_user_log_target(client, user)
+    target = cached_user_log_target(user.id)
+    if target is None:
+        target = await get_user_log_target(client, user)
+    chat_id, root_msg_id = target
     if not chat_id:
         return
 
-    cap = (
-        f"✅ <b>OUTPUT</b>\n"
-        f"• User: <b>{user.first_name or ''}</b> (@{user.username or 'N/A'})\n"
-        f"• ID: <code>{user.id}</code>\n"
-        f"• Context: <code>{context}</code>"
-    )
+    parts = ["✅ <b>OUTPUT</b>\n", log_user_prefix(user), "\n• Context: <code>", context, "</code>"]
     if msg.caption:
-        cap += f"\n\n{msg.caption}"
+        parts += ("\n\n", msg.caption)
+    cap = "".join(parts)
 
-    # text log
-    try:
-        if root_msg_id:
-            await client.send_message(chat_id, cap, reply_to_message_id=root_msg_id)
-        else:
-            await client.send_message(chat_id, cap)
-    except Exception:
-        pass
-
-    # media log by re-sending file_id from msg
-    try:
-        if msg.document:
-            fid = msg.document.file_id
-            if root_msg_id:
-                await client.send_document(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_document(chat_id, fid, caption=cap)
-        elif msg.video:
-            fid = msg.video.file_id
-            if root_msg_id:
-                await client.send_video(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_video(chat_id, fid, caption=cap)
-        elif msg.photo:
-            fid = msg.photo.file_id
-            if root_msg_id:
-                await client.send_photo(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_photo(chat_id, fid, caption=cap)
-        elif msg.audio:
-            fid = msg.audio.file_id
-            if root_msg_id:
-                await client.send_audio(chat_id, fid, caption=cap, reply_to_message_id=root_msg_id)
-            else:
-                await client.send_audio(chat_id, fid, caption=cap)
-    except Exception:
-        pass
+    await _send_log(client, chat_id, root_msg_id, msg, cap)
 
   # ----------------- caption & thumbnail helpers -----------------
 
@@ -326,8 +676,7 @@ def get_caption_cfg(user_id: int) -> Optional[Dict[str, Any]]:
         return None
 
     # TTL: 1 day for non-premium users
-    now = time.time()
-    if not is_premium_user(user_id) and now - cfg.get("updated_at", 0) > 86400:
+    if not is_premium_user(user_id) and _NOW - cfg.get("updated_at", 0) > 86400:
         user_caption_settings.pop(user_id, None)
         return None
 
@@ -354,11 +703,49 @@ def build_caption(user_id: int, default_caption: str) -> str:
     if rfrom and rto:
         caption = caption.replace(rfrom, rto)
 
+    # cfg wahi dict hai jo user_caption_settings me stored hai, re-store ki zaroorat nahi
     cfg["updated_at"] = time.time()
-    user_caption_settings[user_id] = cfg
     return caption
 
 
+def has_numbered_caption(user_id: int) -> bool:
+    # numbered base set ho to counter order matter karta hai -> uploads ek-ek karke
+    cfg = get_caption_cfg(user_id)
+    return bool(cfg and cfg.get("base"))
+
+
+# ffmpeg thumbnail jobs: concurrency capped, same (path, mode) in-flight ho to wahi await
+_THUMB_SEM = asyncio.Semaphore(max(2, (os.cpu_count() or 2) // 2))
+_THUMB_INFLIGHT: Dict[Tuple[str, str], asyncio.Task] = {}
+# remote (URL) thumbs alag slots me + short timeout: slow CDN local thumbs ko na roke
+_REMOTE_THUMB_SEM = asyncio.Semaphore(2)
+REMOTE_THUMB_TIMEOUT = 20
+
+
+async def _make_thumbnail(
+    video_path: str,
+    mode: str,
+    thumb_path: Optional[str] = None,
+    sem: asyncio.Semaphore = _THUMB_SEM,
+) -> Optional[str]:
+    time_pos = "00:00:00.200" if mode == "original" else "00:00:02"
+    if thumb_path is None:
+        # local file: mode-wise thumb video ke bagal me; resend / dobara "send all"
+        # pe ffmpeg dobara nahi (temp_root ke saath hi clean ho jata hai)
+        thumb_path = f"{video_path}.{mode}.jpg"
+        try:
+            if os.stat(thumb_path).st_mtime_ns >= os.stat(video_path).st_mtime_ns:
+                return thumb_path
+        except OSError:
+            pass
+    async with sem:
+        try:
+            await generate_thumbnail(video_path, thumb_path, time_pos=time_pos)
+            return thumb_path
+        except Exception:
+            return None
+
+
 async def choose_thumbnail(user_id: int, video_path: str) -> Optional[str]:
     """
     Choose thumbnail for a local video file based on user setting.
@@ -366,59 +753,105 @@ async def choose_thumbnail(user_id: int, video_path: str) -> Optional[str]:
     'random'    -> frame from a bit later (00:00:02)
     """
     mode = get_thumb_mode(user_id)
-    time_pos = "00:00:00.200" if mode == "original" else "00:00:02"
+    key = (video_path, mode)
+
+    task = _THUMB_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(_make_thumbnail(video_path, mode))
+        _THUMB_INFLIGHT[key] = task
+        task.add_done_callback(lambda _t: _THUMB_INFLIGHT.pop(key, None))
 
-    thumb_path = video_path + ".jpg"
+    return await asyncio.shield(task)
+
+
+async def choose_thumbnail_from_url(
+    user_id: int, src_url: str, thumb_path: str
+) -> Optional[str]:
+    """
+    Remote stream (m3u8) se hi frame nikal leta hai, taaki thumbnail
+    download ke saath-saath ban jaye. Fail / timeout hua to None (local file se banao).
+    """
     try:
-        await generate_thumbnail(video_path, thumb_path, time_pos=time_pos)
-        return thumb_path
-    except Exception:
+        return await asyncio.wait_for(
+            _make_thumbnail(
+                src_url, get_thumb_mode(user_id), thumb_path, sem=_REMOTE_THUMB_SEM
+            ),
+            timeout=REMOTE_THUMB_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
         return None
 
 
 # ----------------- basic helpers -----------------
 
+# bot ka apna User: ek baar fetch, phir har group message pe reuse
+_ME: Optional[User] = None
+_MENTION_RE: Optional[re.Pattern] = None  # @username, case-insensitive
+_ME_LOCK = asyncio.Lock()
+
+
+async def get_me_cached(client: Client) -> User:
+    global _ME, _MENTION_RE
+    if _ME is not None:
+        return _ME
+    async with _ME_LOCK:
+        if _ME is None:
+            me = await client.get_me()
+            if me.username:
+                _MENTION_RE = re.compile(
+                    r"@" + re.escape(me.username) + r"\b", re.IGNORECASE
+                )
+            _ME = me
+    return _ME
+
+
+# force-sub: confirmed members ka result short TTL ke liye cache (user_id -> checked_at)
+_fsub_cache: "OrderedDict[int, float]" = OrderedDict()
+MAX_FSUB_CACHE = 4096
+# first-time lookups single-flight: same user ke concurrent messages pe ek hi RPC
+_FSUB_INFLIGHT: Dict[int, asyncio.Task] = {}
+_FSUB_OK_STATUSES = (
+    enums.ChatMemberStatus.OWNER,
+    enums.ChatMemberStatus.ADMINISTRATOR,
+    enums.ChatMemberStatus.MEMBER,
+)
+
+
+async def _fetch_membership(client: Client, user_id: int) -> bool:
+    try:
+        member = await client.get_chat_member(Config.FORCE_SUB_CHANNEL, user_id)
+    except Exception:
+        return False
+    return member.status in _FSUB_OK_STATUSES
+
 
 async def check_force_sub(client: Client, message: Message) -> bool:
     if not message.from_user:
         return True
     if not Config.FORCE_SUB_CHANNEL:
         return True
-    try:
-        member = await client.get_chat_member(
-            Config.FORCE_SUB_CHANNEL, message.from_user.id
-        )
-        if member.status not in (
-            enums.ChatMemberStatus.OWNER,
-            enums.ChatMemberStatus.ADMINISTRATOR,
-            enums.ChatMemberStatus.MEMBER,
-        ):
-            raise ValueError
-        return True
-    except Exception:
-        kb = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        "Join official channel",
-                        url=f"https://t.me/{Config.FORCE_SUB_CHANNEL}",
-                    )
-                ],
-                [InlineKeyboardButton("Try again", callback_data="retry_force_sub")],
-            ]
-        )
-        try:
-            await message.reply_text(
-                "Yo fam, pehle official channel join karo phir wapas try karo 😎",
-                reply_markup=kb,
-            )
-        except Exception:
-            pass
-        return False
 
+    user_id = message.from_user.id
+    checked_at = _fsub_cache.get(user_id)
+    if checked_at is not None:
+        if _NOW - checked_at < Config.FORCE_SUB_CACHE_TTL:
+            _fsub_cache.move_to_end(user_id)
+            return True
+        _fsub_cache.pop(user_id, None)
+
+    task = _FSUB_INFLIGHT.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_membership(client, user_id))
+        _FSUB_INFLIGHT[user_id] = task
+        task.add_done_callback(lambda _t: _FSUB_INFLIGHT.pop(user_id, None))
+
+    if await asyncio.shield(task):
+        _fsub_cache[user_id] = _NOW
+        if len(_fsub_cache) > MAX_FSUB_CACHE:
+            _fsub_cache.popitem(last=False)
+        return True
 
-def main_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
+    kb = InlineKeyboardMarkup(
         [
             [
                 InlineKeyboardButton(
@@ -426,50 +859,152 @@ def main_keyboard() -> InlineKeyboardMarkup:
                     url=f"https://t.me/{Config.FORCE_SUB_CHANNEL}",
                 )
             ],
-            [
-                InlineKeyboardButton(
-                    "Owner Contact",
-                    url=f"https://t.me/{Config.OWNER_USERNAME}",
-                )
-            ],
+            [InlineKeyboardButton("Try again", callback_data="retry_force_sub")],
         ]
     )
+    try:
+        await message.reply_text(
+            "Yo fam, pehle official channel join karo phir wapas try karo 😎",
+            reply_markup=kb,
+        )
+    except Exception:
+        pass
+    return False
 
 
-def settings_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton("📝 Add Caption", callback_data="settings:caption"),
-                InlineKeyboardButton("🔤 Replace Words", callback_data="settings:replace"),
-            ],
-            [
-                InlineKeyboardButton("📸 Original Thumb", callback_data="settings:thumb:original"),
-                InlineKeyboardButton("🎲 Random Thumb", callback_data="settings:thumb:random"),
-            ],
-            [
-                InlineKeyboardButton("⚙️ Reset Settings", callback_data="settings:reset"),
-            ],
-            [
-                InlineKeyboardButton(
-                    "Owner Contact", url=f"https://t.me/{Config.OWNER_USERNAME}"
-                )
-            ],
-        ]
+# static keyboards: sirf Config pe depend karte hain, import time pe ek baar bana lo
+OWNER_ROW = [
+    InlineKeyboardButton(
+        "Owner Contact", url=f"https://t.me/{Config.OWNER_USERNAME}"
     )
+]
+
+MAIN_KB = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton(
+                "Join official channel",
+                url=f"https://t.me/{Config.FORCE_SUB_CHANNEL}",
+            )
+        ],
+        OWNER_ROW,
+    ]
+)
+
+SETTINGS_KB = InlineKeyboardMarkup(
+    [
+        [
+            InlineKeyboardButton("📝 Add Caption", callback_data="settings:caption"),
+            InlineKeyboardButton("🔤 Replace Words", callback_data="settings:replace"),
+        ],
+        [
+            InlineKeyboardButton("📸 Original Thumb", callback_data="settings:thumb:original"),
+            InlineKeyboardButton("🎲 Random Thumb", callback_data="settings:thumb:random"),
+        ],
+        [
+            InlineKeyboardButton("⚙️ Reset Settings", callback_data="settings:reset"),
+        ],
+        OWNER_ROW,
+    ]
+)
+
+
+def _last_ext(name: str) -> str:
+    # Path().suffix / endswith-loop ki jagah: last "." ke baad ka tail, phir set lookup
+    i = name.rfind(".")
+    return name[i:].lower() if i >= 0 else ""
 
 
 def is_archive_file(name: str) -> bool:
-    n = name.lower()
-    return any(n.endswith(ext) for ext in (".zip", ".rar", ".7z", ".tar", ".gz", ".tgz", ".tar.gz"))
+    return _last_ext(name) in ARCHIVE_EXTS
 
 
 def is_video_file(name: str) -> bool:
-    n = name.lower()
-    return any(n.endswith(ext) for ext in VIDEO_EXT_SET)
+    return _last_ext(name) in VIDEO_EXT_SET
+
+
+def classify_file(name: str) -> Tuple[bool, bool]:
+    """(is_archive, is_video) ek hi suffix lookup se."""
+    ext = _last_ext(name)
+    return ext in ARCHIVE_EXTS, ext in VIDEO_EXT_SET
+
+
+# source messages jinke liye buttons bane: callback pe get_messages RPC bachane ke liye
+_SOURCE_MSGS: "TTLCache[Tuple[int, int], Message]" = TTLCache(
+    maxsize=5000, ttl=SESSION_TTL_SEC
+)
+
+
+def remember_message(msg: Message):
+    _SOURCE_MSGS[(msg.chat.id, msg.id)] = msg
+
+
+async def get_source_message(client: Client, chat_id: int, msg_id: int) -> Message:
+    key = (chat_id, msg_id)
+    msg = _SOURCE_MSGS.get(key)
+    if msg is None:
+        # evicted / restart ke baad -> Telegram se fetch, aur wapas cache karo
+        # taaki agle taps pe dobara RPC na ho
+        msg = await client.get_messages(chat_id, msg_id)
+        if msg is not None and not msg.empty:  # deleted message cache nahi karte
+            _SOURCE_MSGS[key] = msg
+    return msg
+
+
+# compact callback data: "cb|<code>|<chat36>|<msg36>" -> (kind, chat_id, msg_id, extra)
+# deterministic, koi server state nahi: restart / purane messages ke buttons bhi chalte hain
+_CB_CODES: Dict[Tuple[str, str], str] = {
+    ("unzip", "nopass"): "n",
+    ("unzip", "askpass"): "p",
+    ("audio", ""): "a",
+    ("links", "download_all"): "d",
+    ("links", "clean_txt"): "c",
+    ("links", "skip"): "s",
+}
+_CB_KINDS = {code: ref for ref, code in _CB_CODES.items()}
+_B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _to_b36(n: int) -> str:
+    if n < 0:
+        return "-" + _to_b36(-n)
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return out
+
+
+def pack_cb(kind: str, chat_id: int, msg_id: int, extra: str = "") -> str:
+    return f"cb|{_CB_CODES[(kind, extra)]}|{_to_b36(chat_id)}|{_to_b36(msg_id)}"
+
+
+def unpack_cb(rest: str) -> Optional[Tuple[str, int, int, str]]:
+    parts = rest.split("|")
+    try:
+        kind, extra = _CB_KINDS[parts[0]]
+        return kind, int(parts[1], 36), int(parts[2], 36), extra
+    except (IndexError, KeyError, ValueError):
+        return None
+
+
+def _legacy_cb_ref(kind: str, rest: str) -> Optional[Tuple[str, int, int, str]]:
+    """
+    Purane pipe-format buttons ke liye (kind ke baad ka hissa):
+    unzip|chat|msg|mode, audio|chat|msg, links|action|chat|msg
+    """
+    parts = rest.split("|")
+    try:
+        if kind == "links":
+            return kind, int(parts[1]), int(parts[2]), parts[0]
+        return kind, int(parts[0]), int(parts[1]), parts[2] if len(parts) > 2 else ""
+    except (IndexError, ValueError):
+        return None
 
 
 def file_action_keyboard(msg: Message, is_archive: bool, is_video: bool) -> InlineKeyboardMarkup:
+    remember_message(msg)
     chat_id = msg.chat.id
     msg_id = msg.id
     rows = []
@@ -478,11 +1013,11 @@ def file_action_keyboard(msg: Message, is_archive: bool, is_video: bool) -> Inli
             [
                 InlineKeyboardButton(
                     "📦 Unzip",
-                    callback_data=f"unzip|{chat_id}|{msg_id}|nopass",
+                    callback_data=pack_cb("unzip", chat_id, msg_id, "nopass"),
                 ),
                 InlineKeyboardButton(
                     "🔐 With Password",
-                    callback_data=f"unzip|{chat_id}|{msg_id}|askpass",
+                    callback_data=pack_cb("unzip", chat_id, msg_id, "askpass"),
                 ),
             ]
         )
@@ -491,23 +1026,190 @@ def file_action_keyboard(msg: Message, is_archive: bool, is_video: bool) -> Inli
             [
                 InlineKeyboardButton(
                     "🎧 Extract Audio",
-                    callback_data=f"audio|{chat_id}|{msg_id}",
+                    callback_data=pack_cb("audio", chat_id, msg_id),
                 ),
             ]
         )
-    rows.append(
-        [
-            InlineKeyboardButton(
-                "Owner Contact", url=f"https://t.me/{Config.OWNER_USERNAME}"
-            )
-        ]
-    )
+    rows.append(OWNER_ROW)
     return InlineKeyboardMarkup(rows)
 
 
+# ----------------- uploads -----------------
+
+upload_rate_limiter = AsyncLimiter(25, 1)  # bot-wide 30 msg/s cap se neeche
+
+
+async def retry_floodwait(call):
+    """
+    call() chalao; lambi FloodWait (sleep_threshold se upar) aaye to utna
+    wait karke ek retry. Har file ke baad blanket sleep ki zaroorat nahi.
+    """
+    try:
+        return await call()
+    except FloodWait as e:
+        await asyncio.sleep(e.value)
+        return await call()
+
+
+async def upload_media(
+    client: Client,
+    chat_id: int,
+    path: str,
+    name: str,
+    *,
+    user: User,
+    status: Message,
+    reply_to: int,
+    log_note: str,
+    thumb_task: Optional[asyncio.Task] = None,
+    caption: Optional[str] = None,
+    thumb: Optional[str] = None,
+    video: Optional[bool] = None,
+) -> Message:
+    """
+    Local file user ko bhejo. Video -> send_video (user ka caption format +
+    thumb), baaki -> send_document (caption = name). Per-chat + bot-wide
+    limiter, FloodWait retry aur output log sab yahin.
+    thumb_task: caller ne thumb pehle se start kiya ho (status msg ke saath overlap).
+    caption: caller ne pehle se (file order me) build_caption kiya ho to wahi.
+    thumb / video: pehle se bana thumb path; video=None -> name ke extension se decide.
+    """
+    if video is None:
+        video = thumb_task is not None or is_video_file(name)
+        if video and thumb_task is None:
+            thumb_task = asyncio.create_task(choose_thumbnail(user.id, path))
+    start_u = time.time()
+    if video:
+        send = functools.partial(
+            client.send_video,
+            chat_id,
+            path,
+            caption=caption if caption is not None else build_caption(user.id, name),
+            thumb=await thumb_task if thumb_task is not None else thumb,
+        )
+    else:
+        send = functools.partial(client.send_document, chat_id, path, caption=name)
+    async with get_upload_limiter(chat_id), upload_rate_limiter:
+        sent = await retry_floodwait(
+            functools.partial(
+                send,
+                progress=progress_for_pyrogram,
+                progress_args=(status, start_u, name, "to Telegram"),
+                reply_to_message_id=reply_to,
+            )
+        )
+    if sent:
+        enqueue_log(log_user_output, client, user, sent, log_note)
+    return sent
+
+
+# lambe uploads callback handler se bahar: handler bas job daal ke return
+UPLOAD_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=1000)
+UPLOAD_WORKERS = 4
+
+
+async def upload_worker():
+    while True:
+        job = await UPLOAD_QUEUE.get()
+        status: Message = job["status"]
+        try:
+            # caption + thumb download ke dauran hi ban chuke: as-is bhejo
+            await upload_media(
+                app,
+                job["chat_id"],
+                job["path"],
+                job["title"],
+                user=job["user"],
+                status=status,
+                reply_to=job["reply_to"],
+                log_note=job["log_note"],
+                caption=job["caption"],
+                thumb=job["thumb"],
+                video=True,
+            )
+            # delete side-channel: worker agle job pe turant
+            spawn(_delete_quietly(status))
+        except Exception as e:
+            with suppress(Exception):
+                await safe_edit(status, f"Upload fail:\n<code>{e}</code>")
+        finally:
+            UPLOAD_QUEUE.task_done()
+
+
+async def _delete_quietly(msg: Message):
+    with suppress(Exception):
+        await msg.delete()
+
+
 # ----------------- commands -----------------
 
 
+def _render_start_caption(e: List[str]) -> str:
+    # sirf {name} runtime pe bharta hai; baaki text import pe ready.
+    # BOT_NAME env se aata hai: braces escape, warna .format() toot jaye
+    bot_name = Config.BOT_NAME.replace("{", "{{").replace("}", "}}")
+    return (
+        "Hey {name} 👋\n\n"
+        f"Welcome to <b>{bot_name}</b>\n\n"
+        "I’m your all‑in‑one archive & media assistant:\n"
+        f"{e[0]} Unzip 20+ formats (ZIP/RAR/7Z/TAR, with passwords)\n"
+        f"{e[1]} Extract audio from any video\n"
+        f"{e[2]} Auto‑process TXT & links (direct, m3u8, GDrive)\n"
+        f"{e[3]} Smart file listing: send single or all files\n\n"
+        "Use <code>/help</code> to see full usage with examples."
+    )
+
+
+_START_CAPTIONS = tuple(_render_start_caption(emojis(4)) for _ in range(16))
+# /settings ka static upar wala hissa, har emoji ke saath pehle se ready
+_SETTINGS_HEADS = tuple(
+    f"{e} <b>Current Settings</b>\n\n"
+    "• Auto delete temp files: <b>30 minutes</b>\n"
+    "• Default extract mode: <b>Full archive</b>\n"
+    "• Language: <b>English</b>\n\n"
+    "<b>Caption tools:</b>\n"
+    for e in EMOJI_LIST
+)
+
+
+# ----------------- Sharding -----------------
+# Har shard process ko saare updates milte hain; jo user is shard ka nahi
+# uska update yahin rok do. Per-user state (locks, pending, tasks) isi
+# wajah se process-local hi theek rehta hai. Owner commands (/ban, /premium)
+# sirf owner ke shard pe chalte hain -> DB me likhe jate hain aur baaki shards
+# shard_sync_worker se padh lete hain. Isliye SHARDS > 1 ke liye DB zaroori hai.
+
+def _is_my_shard(user: Optional[User], chat: Optional[Chat]) -> bool:
+    key = user.id if user else (chat.id if chat else 0)
+    return key % Config.SHARDS == Config.SHARD_ID
+
+
+if Config.SHARDS > 1:
+
+    @app.on_message(group=-1)
+    async def _shard_gate_message(client: Client, message: Message):
+        if not _is_my_shard(message.from_user, message.chat):
+            message.stop_propagation()
+
+    @app.on_callback_query(group=-1)
+    async def _shard_gate_callback(client: Client, cq: CallbackQuery):
+        if not _is_my_shard(cq.from_user, None):
+            cq.stop_propagation()
+
+
+async def shard_sync_worker():
+    # dusre shards pe hue ban/unban aur premium grants DB se utha lo
+    while True:
+        await asyncio.sleep(Config.SHARD_SYNC_SEC)
+        try:
+            await reload_banned_ids()
+            for uid, until in (await load_premium_until(time.time())).items():
+                if premium_until.get(uid) != until:
+                    grant_premium(uid, until)
+        except Exception as e:
+            print(f"[shard {Config.SHARD_ID}] sync fail: {e!r}")
+
+
 @app.on_message(filters.command("start"))
 async def start_cmd(client: Client, message: Message):
     if not message.from_user:
@@ -519,29 +1221,22 @@ async def start_cmd(client: Client, message: Message):
     if not await check_force_sub(client, message):
         return
 
-    await get_or_create_user(message.from_user.id)
+    await ensure_user(message.from_user.id)
 
-    caption = (
-        f"Hey {message.from_user.first_name or 'there'} 👋\n\n"
-        f"Welcome to <b>{Config.BOT_NAME}</b>\n\n"
-        "I’m your all‑in‑one archive & media assistant:\n"
-        f"{random_emoji()} Unzip 20+ formats (ZIP/RAR/7Z/TAR, with passwords)\n"
-        f"{random_emoji()} Extract audio from any video\n"
-        f"{random_emoji()} Auto‑process TXT & links (direct, m3u8, GDrive)\n"
-        f"{random_emoji()} Smart file listing: send single or all files\n\n"
-        "Use <code>/help</code> to see full usage with examples."
+    caption = random.choice(_START_CAPTIONS).format(
+        name=message.from_user.first_name or "there"
     )
 
     if Config.START_PIC:
         await message.reply_photo(
             Config.START_PIC,
             caption=caption,
-            reply_markup=main_keyboard(),
+            reply_markup=MAIN_KB,
         )
     else:
         await message.reply_text(
             caption,
-            reply_markup=main_keyboard(),
+            reply_markup=MAIN_KB,
         )
 
 
@@ -619,11 +1314,7 @@ async def settings_cmd(client: Client, message: Message):
         status_lines.append("• Replace: <code>None</code>")
 
     text = (
-        f"{random_emoji()} <b>Current Settings</b>\n\n"
-        "• Auto delete temp files: <b>30 minutes</b>\n"
-        "• Default extract mode: <b>Full archive</b>\n"
-        "• Language: <b>English</b>\n\n"
-        "<b>Caption tools:</b>\n" + "\n".join(status_lines) +
+        random.choice(_SETTINGS_HEADS) + "\n".join(status_lines) +
         f"\n\n<b>Thumbnail mode:</b> <code>{thumb_mode}</code>\n"
         "\nUse the buttons below to tweak your caption & thumbnail style."
     )
@@ -632,10 +1323,10 @@ async def settings_cmd(client: Client, message: Message):
         await message.reply_photo(
             Config.START_PIC,
             caption=text,
-            reply_markup=settings_keyboard(),
+            reply_markup=SETTINGS_KB,
         )
     else:
-        await message.reply_text(text, reply_markup=settings_keyboard())
+        await message.reply_text(text, reply_markup=SETTINGS_KB)
 
 
 @app.on_message(filters.command("cancel") & (filters.private | filters.group | filters.channel))
@@ -684,16 +1375,48 @@ async def broadcast_cmd(client: Client, message: Message):
         await message.reply_text("Reply to a message and use /broadcast.")
         return
 
-    users = await get_all_users()
+    # background me chalao taaki baaki handlers serve hote rahein
+    spawn(run_broadcast(message))
+    await message.reply_text("Broadcast started in background…")
+
+
+async def run_broadcast(message: Message):
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
     sent = 0
     failed = 0
-    for uid in users:
-        try:
-            await message.reply_to_message.copy(chat_id=uid)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            failed += 1
+
+    async def send(uid: int) -> bool:
+        # pehle per-chat slot, phir global token (global budget wait me waste na ho)
+        async with get_chat_limiter(uid):
+            async with broadcast_limiter:
+                async with sem:
+                    for _ in range(2):
+                        try:
+                            await message.reply_to_message.copy(chat_id=uid)
+                            return True
+                        except FloodWait as e:
+                            # lambi FloodWait (pyrogram ka auto-sleep threshold se upar): wait + ek retry
+                            await asyncio.sleep(e.value)
+                        except Exception:
+                            return False
+                    return False
+
+    async def flush(batch: List[int]):
+        nonlocal sent, failed
+        results = await asyncio.gather(*(send(uid) for uid in batch))
+        ok = sum(1 for r in results if r)
+        sent += ok
+        failed += len(results) - ok
+
+    # users DB se stream hote hain; fixed-size batches -> memory O(batch)
+    batch: List[int] = []
+    async for uid in get_all_users_iter():
+        batch.append(uid)
+        if len(batch) >= BROADCAST_BATCH:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
 
     await message.reply_text(f"Broadcast done.\nSent: {sent}\nFailed: {failed}")
 
@@ -728,7 +1451,9 @@ async def premium_cmd(client: Client, message: Message):
     if days <= 0:
         days = 10
 
-    premium_until[target_id] = time.time() + days * 86400
+    until = time.time() + days * 86400
+    grant_premium(target_id, until)
+    await set_premium_until(target_id, until)  # baaki shards / restart ke liye
     await message.reply_text(
         f"User <code>{target_id}</code> is premium for <b>{days}</b> day(s).\n"
         f"Caption rules for them won’t auto‑reset during this time."
@@ -779,6 +1504,7 @@ async def clean_cmd(client: Client, message: Message):
     (filters.document | filters.video | filters.photo | filters.audio)
     & (filters.private | filters.group | filters.channel)
 )
+@per_chat_queue
 async def on_file(client: Client, message: Message):
     if not message.from_user:
         return
@@ -791,7 +1517,7 @@ async def on_file(client: Client, message: Message):
 
     chat_type = message.chat.type
 
-    await get_or_create_user(user_id)
+    await ensure_user(user_id)
 
     # log input
     try:
@@ -805,7 +1531,7 @@ async def on_file(client: Client, message: Message):
             ctx = f"audio upload: {message.audio.file_name}"
         else:
             ctx = "media upload"
-        await log_user_input(client, message, ctx)
+        enqueue_log(log_user_input, client, message, ctx)
     except Exception:
         pass
 
@@ -815,22 +1541,32 @@ async def on_file(client: Client, message: Message):
         and message.document
         and (message.document.file_name or "").lower().endswith(".txt")
     ):
-        temp_root = Path(Config.TEMP_DIR) / str(user_id) / uuid.uuid4().hex
-        temp_root.mkdir(parents=True, exist_ok=True)
-        await register_temp_path(user_id, str(temp_root), Config.AUTO_DELETE_DEFAULT_MIN)
-
         status = await message.reply_text("Downloading TXT to parse links…")
+        # chhoti TXT seedha RAM me (disk write + read-back nahi); badi disk pe
+        in_memory = (message.document.file_size or 0) < TXT_IN_MEMORY_MAX
+        if not in_memory:
+            temp_root = new_temp_root(user_id)
+            await register_temp_path(user_id, str(temp_root), Config.AUTO_DELETE_DEFAULT_MIN)
         try:
-            txt_path = await client.download_media(
-                message.document,
-                file_name=str(temp_root),
-            )
+            if in_memory:
+                buf = await client.download_media(message.document, in_memory=True)
+            else:
+                txt_path = await client.download_media(
+                    message.document,
+                    file_name=str(temp_root),
+                )
         except Exception as e:
-            await status.edit_text(f"TXT download failed:\n<code>{e}</code>")
+            await safe_edit(status, f"TXT download failed:\n<code>{e}</code>")
             return
 
         try:
-            content = Path(txt_path).read_text(encoding="utf-8", errors="ignore")
+            if in_memory:
+                content = buf.getvalue().decode("utf-8", errors="ignore")
+            else:
+                # disk read + decode thread me, event loop block na ho
+                content = await asyncio.to_thread(
+                    Path(txt_path).read_text, encoding="utf-8", errors="ignore"
+                )
         except Exception:
             content = ""
 
@@ -847,11 +1583,8 @@ async def on_file(client: Client, message: Message):
         return
     file_name = media.file_name or "file"
 
-    kb = file_action_keyboard(
-        message,
-        is_archive=is_archive_file(file_name),
-        is_video=is_video_file(file_name),
-    )
+    is_archive, is_video = classify_file(file_name)
+    kb = file_action_keyboard(message, is_archive=is_archive, is_video=is_video)
 
     await message.reply_text(
         f"Nice drop: <code>{file_name}</code>\nChoose what you wanna do 👇",
@@ -874,11 +1607,9 @@ async def process_links_message(client: Client, message: Message, content: str):
         "links": links,
         "content": content or "",
     }
+    remember_message(message)
 
-    try:
-        await log_user_input(client, message, f"text links: {len(links)} urls")
-    except Exception:
-        pass
+    enqueue_log(log_user_input, client, message, f"text links: {len(links)} urls")
 
     chat_id = message.chat.id
     msg_id = message.id
@@ -888,17 +1619,17 @@ async def process_links_message(client: Client, message: Message, content: str):
             [
                 InlineKeyboardButton(
                     "⬇️ Download all videos/files",
-                    callback_data=f"links|download_all|{chat_id}|{msg_id}",
+                    callback_data=pack_cb("links", chat_id, msg_id, "download_all"),
                 ),
             ],
             [
                 InlineKeyboardButton(
                     "🧹 Cleaned TXT only",
-                    callback_data=f"links|clean_txt|{chat_id}|{msg_id}",
+                    callback_data=pack_cb("links", chat_id, msg_id, "clean_txt"),
                 ),
                 InlineKeyboardButton(
                     "Skip",
-                    callback_data=f"links|skip|{chat_id}|{msg_id}",
+                    callback_data=pack_cb("links", chat_id, msg_id, "skip"),
                 ),
             ],
         ]
@@ -909,6 +1640,7 @@ async def process_links_message(client: Client, message: Message, content: str):
 
 
 @app.on_message((filters.text | filters.caption) & filters.private)
+@per_chat_queue
 async def on_text(client: Client, message: Message):
     if not message.from_user:
         return
@@ -921,81 +1653,76 @@ async def on_text(client: Client, message: Message):
     if await is_banned(user_id):
         return
 
+    content = message_content(message)
+
     # password reply?
-    if user_id in pending_password:
-        info = pending_password.pop(user_id)
-        password = (message.text or message.caption or "").strip()
-        await handle_unzip_from_password(client, message, info, password)
+    info = pending_password.pop(user_id, None)
+    if info is not None:
+        # download + extract minutes le sakta hai: chat ki FIFO queue ko block na kare
+        spawn(handle_unzip_from_password(client, message, info, content))
         return
 
     # settings reply?
-    if user_id in pending_settings_action:
-        action = pending_settings_action.pop(user_id)
-        txt = (message.text or message.caption or "").strip()
+    action = pending_settings_action.pop(user_id, None)
+    if action is not None:
+        txt = content
+        updates: Optional[Dict[str, Any]] = None
         if action == "caption":
             if not txt:
                 await message.reply_text("Caption can’t be empty. Try again with some text.")
             else:
-                cfg = user_caption_settings.get(user_id) or {}
-                cfg["base"] = txt
-                cfg["counter"] = 0
-                cfg["updated_at"] = time.time()
-                user_caption_settings[user_id] = cfg
-                await message.reply_text(
+                updates = {"base": txt, "counter": 0}
+                reply = (
                     f"Bet. I’ll caption your videos like:\n"
                     f"<code>001 {txt}</code>\n"
                     f"<code>002 {txt}</code> etc. 🔥"
                 )
         elif action == "replace":
-            parts = [p.strip() for p in re.split(r"->|=>", txt, maxsplit=1)]
+            parts = [p.strip() for p in REPLACE_SPLIT_RE.split(txt, maxsplit=1)]
             if len(parts) != 2 or not parts[0]:
                 await message.reply_text(
                     "Format wrong.\nSend like:\n<code>old_text -> new_text</code>"
                 )
             else:
                 old, new = parts
-                cfg = user_caption_settings.get(user_id) or {}
-                cfg["rfrom"] = old
-                cfg["rto"] = new
-                cfg["updated_at"] = time.time()
-                user_caption_settings[user_id] = cfg
-                await message.reply_text(
-                    f"Gotchu. I’ll replace <code>{old}</code> with <code>{new}</code> in captions."
-                )
+                updates = {"rfrom": old, "rto": new}
+                reply = f"Gotchu. I’ll replace <code>{old}</code> with <code>{new}</code> in captions."
+
+        # ek hi jagah cfg mutate
+        if updates:
+            cfg = user_caption_settings.setdefault(user_id, {})
+            cfg.update(updates, updated_at=time.time())
+            await message.reply_text(reply)
         return
 
     if not await check_force_sub(client, message):
         return
 
-    await get_or_create_user(user_id)
+    await ensure_user(user_id)
 
-    content = (message.text or message.caption or "").strip()
     await process_links_message(client, message, content)
 
 
 @app.on_message((filters.text | filters.caption) & (filters.group | filters.channel))
+@per_chat_queue
 async def group_text_handler(client: Client, message: Message):
     if not message.from_user:
         return
 
-    text = (message.text or message.caption or "") or ""
-    if text.lstrip().startswith("/"):
+    text = message_content(message)
+    if text.startswith("/"):
         return
 
     # Mention or reply to bot only
-    me = await client.get_me()
-    mentioned = False
-
-    if me.username and ("@" + me.username.lower()) in text.lower():
-        mentioned = True
-
-    if (
-        message.reply_to_message
-        and message.reply_to_message.from_user
-        and message.reply_to_message.from_user.is_bot
-        and message.reply_to_message.from_user.id == me.id
-    ):
-        mentioned = True
+    me = await get_me_cached(client)
+    reply = message.reply_to_message
+    # sasta reply check pehle, regex scan sirf tab jab reply bot ko nahi hai
+    mentioned = bool(
+        reply
+        and reply.from_user
+        and reply.from_user.is_bot
+        and reply.from_user.id == me.id
+    ) or bool(_MENTION_RE is not None and _MENTION_RE.search(text))
 
     if not mentioned:
         return
@@ -1006,162 +1733,193 @@ async def group_text_handler(client: Client, message: Message):
     if not await check_force_sub(client, message):
         return
 
-    await get_or_create_user(message.from_user.id)
+    await ensure_user(message.from_user.id)
 
-    content = text.strip()
-    await process_links_message(client, message, content)
+    await process_links_message(client, message, text)
 
 
 # ----------------- callback handlers -----------------
 
 
-@app.on_callback_query()
-async def callbacks(client: Client, cq: CallbackQuery):
-    data = cq.data or ""
-    if data == "retry_force_sub":
-        await cq.message.delete()
+async def _cb_retry_force_sub(client: Client, cq: CallbackQuery, rest: str):
+    if cq.from_user:
+        _fsub_cache.pop(cq.from_user.id, None)
+    await cq.message.delete()
+
+
+async def _cb_settings(client: Client, cq: CallbackQuery, action: str):
+    if not cq.from_user:
+        await cq.answer()
         return
+    user_id = cq.from_user.id
 
-    # Settings actions
-    if data.startswith("settings:"):
-        if not cq.from_user:
-            await cq.answer()
-            return
-        user_id = cq.from_user.id
-        action = data.split(":", 1)[1]
-
-        if action == "reset":
-            user_caption_settings.pop(user_id, None)
-            user_thumb_mode.pop(user_id, None)
-            await cq.message.edit_text(
-                "Your caption/replace/thumb settings are back to default 🤙",
-                reply_markup=settings_keyboard(),
-            )
-            await cq.answer("Settings reset", show_alert=False)
-            return
+    if action == "reset":
+        user_caption_settings.pop(user_id, None)
+        user_thumb_mode.pop(user_id, None)
+        await safe_edit(
+            cq.message,
+            "Your caption/replace/thumb settings are back to default 🤙",
+            reply_markup=SETTINGS_KB,
+        )
+        await cq.answer("Settings reset", show_alert=False)
+        return
 
-        if action == "caption":
-            pending_settings_action[user_id] = "caption"
-            await cq.message.reply_text(
-                "Send me the base caption text.\n\n"
-                "Example: <code>My Serena Pack</code>\n\n"
-                "I’ll use it like:\n"
-                "<code>001 My Serena Pack</code>\n"
-                "<code>002 My Serena Pack</code> etc."
-            )
-            await cq.answer()
-            return
+    if action == "caption":
+        pending_settings_action[user_id] = "caption"
+        await cq.message.reply_text(
+            "Send me the base caption text.\n\n"
+            "Example: <code>My Serena Pack</code>\n\n"
+            "I’ll use it like:\n"
+            "<code>001 My Serena Pack</code>\n"
+            "<code>002 My Serena Pack</code> etc."
+        )
+        await cq.answer()
+        return
 
-        if action == "replace":
-            pending_settings_action[user_id] = "replace"
-            await cq.message.reply_text(
-                "Send the replace rule in this format:\n"
-                "<code>old_text -> new_text</code>\n\n"
-                "Example:\n<code>kumari -> serena</code>\n"
-                "I’ll replace <b>kumari</b> with <b>serena</b> in captions."
+    if action == "replace":
+        pending_settings_action[user_id] = "replace"
+        await cq.message.reply_text(
+            "Send the replace rule in this format:\n"
+            "<code>old_text -> new_text</code>\n\n"
+            "Example:\n<code>kumari -> serena</code>\n"
+            "I’ll replace <b>kumari</b> with <b>serena</b> in captions."
+        )
+        await cq.answer()
+        return
+
+    if action.startswith("thumb:"):
+        mode = action.split(":", 1)[1]
+        if mode in ("original", "random"):
+            user_thumb_mode[user_id] = mode
+            msg_txt = (
+                "📸 Original thumbnails enabled ✅"
+                if mode == "original"
+                else "🎲 Random thumbnails enabled ✅"
             )
-            await cq.answer()
-            return
+            await cq.message.reply_text(msg_txt)
+        await cq.answer()
+        return
 
-        if action.startswith("thumb:"):
-            mode = action.split(":", 1)[1]
-            if mode in ("original", "random"):
-                user_thumb_mode[user_id] = mode
-                msg_txt = (
-                    "📸 Original thumbnails enabled ✅"
-                    if mode == "original"
-                    else "🎲 Random thumbnails enabled ✅"
-                )
-                await cq.message.reply_text(msg_txt)
-            await cq.answer()
-            return
+    await cq.answer()
 
-    # Unzip
-    if data.startswith("unzip|"):
-        try:
-            _, chat_id, msg_id, mode = data.split("|", 3)
-            original_msg = await client.get_messages(int(chat_id), int(msg_id))
-        except Exception:
-            await cq.answer("Original file nahi mila.", show_alert=True)
-            return
-        await handle_unzip_button(client, cq, original_msg, mode)
+
+async def _cb_message_ref(
+    client: Client, cq: CallbackQuery, ref: Optional[Tuple[str, int, int, str]]
+):
+    if ref is None:
+        await cq.answer("Original message nahi mila.", show_alert=True)
         return
 
-    # Unzip cancel session
-    if data.startswith("ucancel|"):
-        _, task_id = data.split("|", 1)
-        tasks.pop(task_id, None)
-        try:
-            await cq.message.edit_text("Unzip session cancelled ✅")
-        except Exception:
-            pass
-        await cq.answer()
+    kind, chat_id, msg_id, extra = ref
+    try:
+        original_msg = await get_source_message(client, chat_id, msg_id)
+    except Exception:
+        await cq.answer("Original message nahi mila.", show_alert=True)
         return
 
-    # Audio extract
-    if data.startswith("audio|"):
-        try:
-            _, chat_id, msg_id = data.split("|", 2)
-            original_msg = await client.get_messages(int(chat_id), int(msg_id))
-        except Exception:
-            await cq.answer("Original video nahi mila.", show_alert=True)
-            return
+    if kind == "unzip":
+        await handle_unzip_button(client, cq, original_msg, extra)
+    elif kind == "audio":
         await handle_extract_audio(client, cq, original_msg)
+    elif kind == "links":
+        await handle_links_action(client, cq, original_msg, extra)
+    else:
+        await cq.answer()
+
+
+async def _cb_packed(client: Client, cq: CallbackQuery, rest: str):
+    await _cb_message_ref(client, cq, unpack_cb(rest))
+
+
+def _cb_legacy(kind: str):
+    async def route(client: Client, cq: CallbackQuery, rest: str):
+        await _cb_message_ref(client, cq, _legacy_cb_ref(kind, rest))
+
+    return route
+
+
+async def _cb_ucancel(client: Client, cq: CallbackQuery, task_id: str):
+    tasks.pop(task_id, None)
+    try:
+        await safe_edit(cq.message, "Unzip session cancelled ✅")
+    except Exception:
+        pass
+    await cq.answer()
+
+
+async def _cb_sendall(client: Client, cq: CallbackQuery, task_id: str):
+    await handle_send_all(client, cq, task_id)
+
+
+async def _cb_sendone(client: Client, cq: CallbackQuery, rest: str):
+    task_id, _, index = rest.partition("|")
+    try:
+        idx = int(index)
+    except ValueError:
+        await cq.answer("Invalid index.", show_alert=True)
         return
+    await handle_send_one(client, cq, task_id, idx)
 
-    # send all/single extracted
-    if data.startswith("sendall|"):
-        _, task_id = data.split("|", 1)
-        await handle_send_all(client, cq, task_id)
-        return
 
-    if data.startswith("sendone|"):
-        _, task_id, index = data.split("|", 2)
-        await handle_send_one(client, cq, task_id, int(index))
+async def _cb_m3q(client: Client, cq: CallbackQuery, rest: str):
+    task_id, _, idx_str = rest.partition("|")
+    try:
+        index = int(idx_str)
+    except ValueError:
+        await cq.answer("Invalid selection.", show_alert=True)
         return
+    await handle_m3u8_quality_choice(client, cq, task_id, index)
 
-    # links actions
-    if data.startswith("links|"):
-        parts = data.split("|", 3)
-        if len(parts) < 4:
-            await cq.answer("Original message nahi mila.", show_alert=True)
-            return
-        _, action, chat_id, msg_id = parts
-        try:
-            original_msg = await client.get_messages(int(chat_id), int(msg_id))
-        except Exception:
-            await cq.answer("Original message nahi mila.", show_alert=True)
-            return
 
-        key = (original_msg.chat.id, original_msg.id)
-        session = LINK_SESSIONS.get(key)
-        content = session["content"] if session else (original_msg.text or original_msg.caption or "") or ""
-        links = session["links"] if session else find_links_in_text(content)
-
-        if action == "clean_txt":
-            await cq.answer()
-            txt = "\n".join(sorted(set(links))) or "No valid URLs found."
-            await cq.message.edit_text("<b>Cleaned URLs:</b>\n\n" + txt[:4000])
-        elif action == "download_all":
-            await cq.answer()
-            await handle_links_download_all(client, cq, original_msg)
-        else:
-            await cq.answer()
-            await cq.message.edit_text("Skipped link processing.")
-        return
+# callback_data head -> route(client, cq, rest)
+CB_ROUTES = {
+    "retry_force_sub": _cb_retry_force_sub,
+    "settings": _cb_settings,
+    "cb": _cb_packed,
+    "unzip": _cb_legacy("unzip"),
+    "audio": _cb_legacy("audio"),
+    "links": _cb_legacy("links"),
+    "ucancel": _cb_ucancel,
+    "sendall": _cb_sendall,
+    "sendone": _cb_sendone,
+    "m3q": _cb_m3q,
+}
 
-    # m3u8 quality choice
-    if data.startswith("m3q|"):
-        try:
-            _, task_id, idx_str = data.split("|", 2)
-            index = int(idx_str)
-        except Exception:
-            await cq.answer("Invalid selection.", show_alert=True)
-            return
-        await handle_m3u8_quality_choice(client, cq, task_id, index)
+
+@app.on_callback_query()
+async def callbacks(client: Client, cq: CallbackQuery):
+    data = cq.data or ""
+    if data.startswith("cb|"):
+        # file/link buttons (sabse zyada taps): seedha decode
+        await _cb_packed(client, cq, data[3:])
+        return
+    head, _, rest = data.partition("|" if "|" in data else ":")
+    route = CB_ROUTES.get(head)
+    if route is None:
+        await cq.answer()
         return
+    await route(client, cq, rest)
+
+
+async def handle_links_action(
+    client: Client, cq: CallbackQuery, original_msg: Message, action: str
+):
+    key = (original_msg.chat.id, original_msg.id)
+    session = LINK_SESSIONS.get(key)
+    content = session["content"] if session else message_content(original_msg)
+    links = session["links"] if session else find_links_in_text(content)
+
+    if action == "clean_txt":
+        await cq.answer()
+        txt = "\n".join(sorted(dict.fromkeys(links))) or "No valid URLs found."
+        await safe_edit(cq.message, "<b>Cleaned URLs:</b>\n\n" + txt[:4000])
+    elif action == "download_all":
+        await cq.answer()
+        await handle_links_download_all(client, cq, original_msg)
+    else:
+        await cq.answer()
+        await safe_edit(cq.message, "Skipped link processing.")
 
-    await cq.answer()
 
 # ----------------- unzip & audio -----------------
 
@@ -1212,7 +1970,7 @@ async def handle_unzip_from_password(
 ):
     chat_id = info["chat_id"]
     msg_id = info["msg_id"]
-    original_msg = await client.get_messages(chat_id, msg_id)
+    original_msg = await get_source_message(client, chat_id, msg_id)
     await msg.reply_text("Got the password, starting extraction…")
     await run_unzip_task(client, original_msg, password=password)
 
@@ -1230,16 +1988,17 @@ async def run_unzip_task(client: Client, msg: Message, password: Optional[str]):
         return
 
     async with lock:
-        user_cancelled[user_id] = False
+        # pichla archive abhi extract ho raha ho to uska /cancel mat mitao
+        if not get_lock(("extract", user_id)).locked():
+            user_cancelled.pop(user_id, None)
         doc = msg.document
         file_name = doc.file_name or "archive"
         size_bytes = doc.file_size or 0
         size_mb = size_bytes / (1024 * 1024)
 
-        await get_or_create_user(user_id)
+        await ensure_user(user_id)
 
-        temp_root = Path(Config.TEMP_DIR) / str(user_id) / uuid.uuid4().hex
-        temp_root.mkdir(parents=True, exist_ok=True)
+        temp_root = new_temp_root(user_id)
 
         await register_temp_path(user_id, str(temp_root), Config.AUTO_DELETE_DEFAULT_MIN)
 
@@ -1247,65 +2006,95 @@ async def run_unzip_task(client: Client, msg: Message, password: Optional[str]):
 
         start = time.time()
         try:
-            downloaded_path = await client.download_media(
+            downloaded_path = await download_tg_file(
+                client,
                 doc,
-                file_name=str(temp_root),
+                str(temp_root / os.path.basename(file_name)),
                 progress=progress_for_pyrogram,
                 progress_args=(status_msg, start, file_name, "to my server"),
             )
         except Exception as e:
-            await status_msg.edit_text(f"Download fail ho gaya:\n<code>{e}</code>")
+            await safe_edit(status_msg, f"Download fail ho gaya:\n<code>{e}</code>")
             return
 
         if not downloaded_path:
-            await status_msg.edit_text("Download hua nahi, file path missing hai.")
+            await safe_edit(status_msg, "Download hua nahi, file path missing hai.")
             return
 
         archive_path = downloaded_path
 
-        try:
-            await log_user_input(client, msg, f"archive: {file_name}")
-        except Exception:
-            pass
+        enqueue_log(log_user_input, client, msg, f"archive: {file_name}")
 
-        if user_cancelled.get(user_id):
-            await status_msg.edit_text("Task cancel kar diya ✅")
+        if user_id in user_cancelled:
+            await safe_edit(status_msg, "Task cancel kar diya ✅")
             return
 
-        if not password and detect_encrypted(archive_path):
-            await status_msg.edit_text(
+        if not password and await asyncio.to_thread(detect_encrypted, archive_path):
+            await safe_edit(
+                status_msg,
                 "Archive password protected lag rahi hai.\n"
                 "Use 'With Password' button & try again."
             )
             return
 
-        await status_msg.edit_text("Extraction shuru… Thoda sabr 😎")
+    # download khatam -> user lock chhod do: agla archive ab download ho sakta hai
+    # jab tak ye wala extract ho raha hai (network aur CPU overlap)
+    await _extract_and_summarize(
+        user_id, status_msg, archive_path, temp_root, password, size_mb
+    )
+
+
+async def _extract_and_summarize(
+    user_id: int,
+    status_msg: Message,
+    archive_path: str,
+    temp_root: Path,
+    password: Optional[str],
+    size_mb: float,
+):
+    # same user ke extractions ek ke baad ek (per-user CPU share fair rahe)
+    extract_lock = get_lock(("extract", user_id))
+    if extract_lock.locked():
+        await safe_edit(status_msg, "Pichla archive extract ho raha hai, queue me hai… ⏳")
+
+    async with extract_lock:
+        await safe_edit(status_msg, "Extraction shuru… Thoda sabr 😎")
         extract_dir = temp_root / "extracted"
         try:
-            result = extract_archive(archive_path, str(extract_dir), password=password)
+            # decompression CPU-heavy hai -> alag process, GIL/event loop free rahe
+            loop = asyncio.get_running_loop()
+            async with EXTRACT_SEM:
+                result = await loop.run_in_executor(
+                    EXTRACT_POOL, extract_archive, archive_path, str(extract_dir), password
+                )
         except Exception as e:
-            await status_msg.edit_text(f"Extract error:\n<code>{e}</code>")
+            await safe_edit(status_msg, f"Extract error:\n<code>{e}</code>")
             return
 
-        if user_cancelled.get(user_id):
-            await status_msg.edit_text(
+        if user_id in user_cancelled:
+            await safe_edit(
+                status_msg,
                 "Task cancel ho gaya mid‑way, output skip kar diya."
             )
             return
 
         stats = result["stats"]
-        files = sorted(result["files"], key=lambda p: p.lower())
+        files = result["files"]  # extract_archive already sorted (key=str.lower)
 
-        links_map = extract_links_from_folder(str(extract_dir))
+        # file scan + regex bhi CPU kaam hai: thread (GIL) ki jagah process pool
+        async with EXTRACT_SEM:
+            links_map = await loop.run_in_executor(
+                EXTRACT_POOL, extract_links_from_folder, str(extract_dir)
+            )
 
-        task_id = uuid.uuid4().hex
-        tasks[task_id] = {
-            "type": "unzip",
-            "user_id": user_id,
-            "base_dir": str(extract_dir),
-            "files": files,
-            "archive_name": os.path.basename(archive_path),
-        }
+        task_id = new_task_id()
+        tasks[task_id] = UnzipTask(
+            user_id=user_id,
+            base_dir=str(extract_dir),
+            files=files,
+            is_video=[is_video_file(rel) for rel in files],
+            archive_name=os.path.basename(archive_path),
+        )
 
         summary = (
             f"<b>Extraction done ✅</b>\n\n"
@@ -1330,17 +2119,19 @@ async def run_unzip_task(client: Client, msg: Message, password: Optional[str]):
         )
 
         max_files_buttons = 25
-        for idx, rel_path in enumerate(files[:max_files_buttons]):
-            short = rel_path
-            if len(short) > 40:
-                short = "..." + short[-37:]
-            rows.append(
-                [InlineKeyboardButton(short, callback_data=f"sendone|{task_id}|{idx}")]
-            )
+        rows.extend(
+            [
+                InlineKeyboardButton(
+                    rel_path if len(rel_path) <= 40 else "..." + rel_path[-37:],
+                    callback_data=f"sendone|{task_id}|{idx}",
+                )
+            ]
+            for idx, rel_path in enumerate(files[:max_files_buttons])
+        )
 
         kb = InlineKeyboardMarkup(rows)
 
-        await status_msg.edit_text(summary, reply_markup=kb)
+        await safe_edit(status_msg, summary, reply_markup=kb)
         await update_user_stats(user_id, size_mb)
 
 
@@ -1354,17 +2145,17 @@ async def handle_send_all(client: Client, cq: CallbackQuery, task_id: str):
         await cq.answer()
         return
     user = cq.from_user
-    if user.id != info["user_id"]:
+    if user.id != info.user_id:
         await cq.answer("Ye tumhara task nahi hai.", show_alert=True)
         return
 
-    base_dir = Path(info["base_dir"])
-    files = info["files"]
-    archive_name = info.get("archive_name", "archive")
+    base_dir = info.base_dir
+    files = info.files
+    archive_name = info.archive_name
 
     await cq.answer()
-    await cq.message.edit_text(
-        "Sending all extracted files… thoda time lag sakta hai."
+    await safe_edit(
+        cq.message, "Sending all extracted files… thoda time lag sakta hai."
     )
 
     chat_id = cq.message.chat.id
@@ -1379,76 +2170,83 @@ async def handle_send_all(client: Client, cq: CallbackQuery, task_id: str):
         except Exception:
             pinned = False
 
-    for rel in files:
-        if user_cancelled.get(user.id):
-            break
-
-        full = base_dir / rel
-        if not full.is_file():
-            continue
-        try:
-            sent = None
-            if is_video_path(rel):
-                name = Path(rel).name
-                base_caption = name
-                caption = build_caption(user.id, base_caption)
-                thumb_arg = await choose_thumbnail(user.id, str(full))
-
-                status = await client.send_message(
-                    chat_id,
-                    f"Uploading: {name}",
-                    reply_to_message_id=reply_to,
+    # video captions file order me pehle hi: numbered caption ka counter upload
+    # completion order pe na chale; numbered ho to delivery bhi order me (ek-ek)
+    captions = [
+        build_caption(user.id, os.path.basename(rel)) if is_video else None
+        for rel, is_video in zip(files, info.is_video)
+    ]
+    sem = asyncio.Semaphore(1 if has_numbered_caption(user.id) else UPLOAD_CONCURRENCY)
+    total = len(files)
+    # har upload slot ka ek live status msg: per file send+delete ki jagah edit
+    status_pool: asyncio.Queue = asyncio.Queue()
+    status_msgs: List[Message] = []
+
+    async def _take_status(text: str) -> Message:
+        if status_pool.empty():
+            status = await client.send_message(
+                chat_id, text, reply_to_message_id=reply_to
+            )
+            status_msgs.append(status)
+            return status
+        status = status_pool.get_nowait()
+        with suppress(Exception):
+            await safe_edit(status, text)
+        return status
+
+    async def _upload_one(i: int, rel: str, is_video: bool, caption: Optional[str]):
+        async with sem:
+            if user.id in user_cancelled:
+                return
+
+            full = os.path.join(base_dir, rel)
+            if not os.path.isfile(full):
+                return
+            status = None
+            try:
+                name = os.path.basename(rel) if is_video else rel
+                # thumb ka kaam status msg ke saath overlap
+                thumb_task = (
+                    asyncio.create_task(choose_thumbnail(user.id, full))
+                    if is_video
+                    else None
                 )
-                start_u = time.time()
-                sent = await client.send_video(
+                status = await _take_status(f"Uploading {i}/{total}: {name}")
+                await upload_media(
+                    client,
                     chat_id,
-                    str(full),
+                    full,
+                    name,
+                    user=user,
+                    status=status,
+                    reply_to=reply_to,
+                    log_note=f"unzip send_all from {archive_name}",
+                    thumb_task=thumb_task,
                     caption=caption,
-                    thumb=thumb_arg,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, name, "to Telegram"),
-                    reply_to_message_id=reply_to,
-                )
-                try:
-                    await status.delete()
-                except Exception:
-                    pass
-            else:
-                status = await client.send_message(
-                    chat_id,
-                    f"Uploading: {rel}",
-                    reply_to_message_id=reply_to,
-                )
-                start_u = time.time()
-                sent = await client.send_document(
-                    chat_id=chat_id,
-                    document=str(full),
-                    caption=rel,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, rel, "to Telegram"),
-                    reply_to_message_id=reply_to,
                 )
-                try:
-                    await status.delete()
-                except Exception:
-                    pass
-
-            if sent:
-                try:
-                    await log_user_output(
-                        client, user, sent, f"unzip send_all from {archive_name}"
-                    )
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        await asyncio.sleep(0.5)
+            except Exception:
+                pass
+            finally:
+                if status is not None:
+                    status_pool.put_nowait(status)
+
+    await asyncio.gather(
+        *(
+            _upload_one(i, rel, is_video, caption)
+            for i, (rel, is_video, caption) in enumerate(
+                zip(files, info.is_video, captions), 1
+            )
+        ),
+        return_exceptions=True,
+    )
+
+    for status in status_msgs:
+        with suppress(Exception):
+            await status.delete()
 
     if is_private and pinned:
-        try:
+        with suppress(Exception):
             await client.unpin_chat_message(chat_id, cq.message.id)
-        except Exception:
-            pass
 
     await client.send_message(chat_id, "All extracted files sent ✅", reply_to_message_id=reply_to)
 
@@ -1465,20 +2263,20 @@ async def handle_send_one(
         await cq.answer()
         return
     user = cq.from_user
-    if user.id != info["user_id"]:
+    if user.id != info.user_id:
         await cq.answer("Ye tumhara task nahi hai.", show_alert=True)
         return
 
-    files = info["files"]
+    files = info.files
     if index < 0 or index >= len(files):
         await cq.answer("Invalid index.", show_alert=True)
         return
 
     await cq.answer()
-    base_dir = Path(info["base_dir"])
     rel = files[index]
-    full = base_dir / rel
-    if not full.is_file():
+    is_video = info.is_video[index]
+    full = os.path.join(info.base_dir, rel)
+    if not os.path.isfile(full):
         await cq.message.reply_text("File missing ho gayi lagti hai.")
         return
 
@@ -1486,62 +2284,29 @@ async def handle_send_one(
     reply_to = cq.message.id
 
     try:
-        sent = None
-        if is_video_path(rel):
-            name = Path(rel).name
-            base_caption = name
-            caption = build_caption(user.id, base_caption)
-            thumb_arg = await choose_thumbnail(user.id, str(full))
-
-            status = await client.send_message(
-                chat_id,
-                f"Uploading: {name}",
-                reply_to_message_id=reply_to,
-            )
-            start_u = time.time()
-            sent = await client.send_video(
-                chat_id,
-                str(full),
-                caption=caption,
-                thumb=thumb_arg,
-                progress=progress_for_pyrogram,
-                progress_args=(status, start_u, name, "to Telegram"),
-                reply_to_message_id=reply_to,
-            )
-            try:
-                await status.delete()
-            except Exception:
-                pass
-        else:
-            status = await client.send_message(
-                chat_id,
-                f"Uploading: {rel}",
-                reply_to_message_id=reply_to,
-            )
-            start_u = time.time()
-            sent = await client.send_document(
-                chat_id=chat_id,
-                document=str(full),
-                caption=rel,
-                progress=progress_for_pyrogram,
-                progress_args=(status, start_u, rel, "to Telegram"),
-                reply_to_message_id=reply_to,
-            )
-            try:
-                await status.delete()
-            except Exception:
-                pass
-
-        if sent:
-            try:
-                await log_user_output(
-                    client,
-                    user,
-                    sent,
-                    f"unzip send_one from {info.get('archive_name','archive')}",
-                )
-            except Exception:
-                pass
+        name = os.path.basename(rel) if is_video else rel
+        # thumb ka kaam status msg ke saath overlap
+        thumb_task = (
+            asyncio.create_task(choose_thumbnail(user.id, full)) if is_video else None
+        )
+        status = await client.send_message(
+            chat_id,
+            f"Uploading: {name}",
+            reply_to_message_id=reply_to,
+        )
+        await upload_media(
+            client,
+            chat_id,
+            full,
+            name,
+            user=user,
+            status=status,
+            reply_to=reply_to,
+            log_note=f"unzip send_one from {info.archive_name}",
+            thumb_task=thumb_task,
+        )
+        with suppress(Exception):
+            await status.delete()
     except Exception:
         pass
 
@@ -1573,8 +2338,7 @@ async def handle_extract_audio(client: Client, cq: CallbackQuery, msg: Message):
     async with lock:
         file_name = video.file_name or "video"
         base_name = os.path.splitext(file_name)[0]
-        temp_root = Path(Config.TEMP_DIR) / str(user_id) / uuid.uuid4().hex
-        temp_root.mkdir(parents=True, exist_ok=True)
+        temp_root = new_temp_root(user_id)
 
         await register_temp_path(
             user_id, str(temp_root), Config.AUTO_DELETE_DEFAULT_MIN
@@ -1594,11 +2358,11 @@ async def handle_extract_audio(client: Client, cq: CallbackQuery, msg: Message):
                 progress_args=(status, start, file_name, "to my server"),
             )
         except Exception as e:
-            await status.edit_text(f"Download fail:\n<code>{e}</code>")
+            await safe_edit(status, f"Download fail:\n<code>{e}</code>")
             return
 
         if not downloaded_path:
-            await status.edit_text("Download hua nahi, file path missing hai.")
+            await safe_edit(status, "Download hua nahi, file path missing hai.")
             return
 
         video_path = downloaded_path
@@ -1606,10 +2370,10 @@ async def handle_extract_audio(client: Client, cq: CallbackQuery, msg: Message):
         try:
             await extract_audio(video_path, audio_path)
         except Exception as e:
-            await status.edit_text(f"ffmpeg error:\n<code>{e}</code>")
+            await safe_edit(status, f"ffmpeg error:\n<code>{e}</code>")
             return
 
-        await status.edit_text("Uploading audio to you…")
+        await safe_edit(status, "Uploading audio to you…")
         try:
             start_u = time.time()
             sent = await client.send_document(
@@ -1620,16 +2384,9 @@ async def handle_extract_audio(client: Client, cq: CallbackQuery, msg: Message):
                 progress_args=(status, start_u, f"{base_name}.m4a", "to Telegram"),
                 reply_to_message_id=reply_to,
             )
-            try:
+            with suppress(Exception):
                 await status.delete()
-            except Exception:
-                pass
-            try:
-                await log_user_output(
-                    client, user, sent, "audio extracted from video"
-                )
-            except Exception:
-                pass
+            enqueue_log(log_user_output, client, user, sent, "audio extracted from video")
         except Exception:
             pass
 
@@ -1641,34 +2398,29 @@ async def handle_links_download_all(
 ):
     key = (original_msg.chat.id, original_msg.id)
     session = LINK_SESSIONS.get(key)
-    content = session["content"] if session else (original_msg.text or original_msg.caption or "") or ""
+    content = session["content"] if session else message_content(original_msg)
     all_links = session["links"] if session else find_links_in_text(content)
     if not all_links:
-        await cq.message.edit_text("Koi URL nahi mila.")
+        await safe_edit(cq.message, "Koi URL nahi mila.")
         return
 
     # categorize
-    cats: Dict[str, list] = {
-        "direct": [],
-        "m3u8": [],
-        "gdrive": [],
-        "telegram": [],
-        "unknown": [],
-    }
+    cats: Dict[str, list] = defaultdict(list)
+    candidate_direct: List[str] = []  # direct + unknown, same pass me
     for url in all_links:
         kind = classify_link(url)
-        cats.setdefault(kind, [])
         cats[kind].append(url)
+        if kind in ("direct", "unknown"):
+            candidate_direct.append(url)
 
-    direct_links = cats.get("direct", [])
-    m3u8_links = cats.get("m3u8", [])
-    gdrive_links = cats.get("gdrive", [])
-    unknown_links = cats.get("unknown", [])
-
-    candidate_direct = direct_links + unknown_links
+    direct_links = cats["direct"]
+    m3u8_links = cats["m3u8"]
+    gdrive_links = cats["gdrive"]
+    unknown_links = cats["unknown"]
 
     if not candidate_direct and not m3u8_links and not gdrive_links:
-        await cq.message.edit_text(
+        await safe_edit(
+            cq.message,
             "Direct/m3u8/GDrive type supported links nahi mile.\n"
             "Telegram / unknown complex links ke liye auto-download off hai."
         )
@@ -1679,8 +2431,7 @@ async def handle_links_download_all(
     user = cq.from_user
     user_id = user.id
 
-    temp_root = Path(Config.TEMP_DIR) / str(user_id) / uuid.uuid4().hex
-    temp_root.mkdir(parents=True, exist_ok=True)
+    temp_root = new_temp_root(user_id)
     await register_temp_path(
         user_id, str(temp_root), Config.AUTO_DELETE_DEFAULT_MIN
     )
@@ -1690,15 +2441,9 @@ async def handle_links_download_all(
         f"GDrive: {len(gdrive_links)} | m3u8: {len(m3u8_links)}\n"
         "Downloading supported direct/GDrive files pehle…"
     )
-    try:
-        await cq.message.edit_text(first_text)
-    except MessageNotModified:
-        pass
-    except Exception:
-        pass
+    with suppress(Exception):
+        await safe_edit(cq.message, first_text)
 
-    ok = 0
-    fail = 0
     chat_id = cq.message.chat.id
     reply_to = cq.message.id
     is_private = cq.message.chat.type == enums.ChatType.PRIVATE
@@ -1711,141 +2456,87 @@ async def handle_links_download_all(
         except Exception:
             pinned = False
 
-    # direct + unknown as direct
-    for url in candidate_direct:
-        if user_cancelled.get(user_id):
-            break
-
-        base_raw = url.split("?", 1)[0].split("#", 1)[0]
-        base_guess = base_raw.rsplit("/", 1)[-1] or f"file_{uuid.uuid4().hex}"
-        dest_path = str(temp_root / base_guess)
-        try:
+    # direct + unknown as direct, phir GDrive: sab ek saath (UPLOAD_CONCURRENCY tak);
+    # downloads bot-wide HEAVY_SEM se bounded rehte hain
+    jobs: List[Tuple[str, Optional[str], str, str, str]] = [
+        (url, url, "Downloading from link", "file", "direct/unknown link")
+        for url in candidate_direct
+    ]
+    jobs.extend(
+        (url, get_gdrive_direct_link(url), "Downloading from GDrive", "gdrive", "GDrive link")
+        for url in gdrive_links
+    )
+    # numbered caption: link order me ek-ek (counter completion order pe na chale)
+    sem = asyncio.Semaphore(1 if has_numbered_caption(user_id) else UPLOAD_CONCURRENCY)
+
+    async def _fetch_and_send(
+        url: str, src_url: Optional[str], label: str, prefix: str, log_note: str
+    ) -> Optional[bool]:
+        if not src_url:
+            return False
+        async with sem:
+            if user_id in user_cancelled:
+                return None  # cancel: na ok na fail
+            base_guess = urlsplit(src_url).path.rpartition("/")[2] or f"{prefix}_{short_id()}"
+            # har job ka apna subdir: parallel jobs same basename (GDrive "uc",
+            # "index.mp4") pe ek hi file me na likhein / ek dusre ki file na hatayein
+            job_dir = temp_root / short_id()
+            dest_path = str(job_dir / base_guess)
             status = await client.send_message(
                 chat_id,
-                f"Downloading from link:\n{url}",
+                f"{label}:\n{url}",
                 reply_to_message_id=reply_to,
             )
-            final_path = await download_file(
-                url,
-                dest_path,
-                status_message=status,
-                file_name=base_guess,
-                direction="to my server",
-            )
-            basename = os.path.basename(final_path)
-            await status.edit_text(f"Uploading to you:\n{basename}")
-            if is_video_path(basename):
-                base_caption = basename
-                caption = build_caption(user_id, base_caption)
-                thumb_arg = await choose_thumbnail(user_id, final_path)
-
-                start_u = time.time()
-                sent = await client.send_video(
-                    chat_id,
-                    final_path,
-                    caption=caption,
-                    thumb=thumb_arg,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, basename, "to Telegram"),
-                    reply_to_message_id=reply_to,
-                )
-            else:
-                start_u = time.time()
-                sent = await client.send_document(
-                    chat_id,
-                    final_path,
-                    caption=basename,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, basename, "to Telegram"),
-                    reply_to_message_id=reply_to,
+            async with HEAVY_SEM:
+                final_path = await download_file(
+                    src_url,
+                    dest_path,
+                    status_message=status,
+                    file_name=base_guess,
+                    direction="to my server",
+                    session=get_http_session(),
                 )
-            try:
-                await status.delete()
-            except Exception:
-                pass
-            ok += 1
-            try:
-                await log_user_output(
-                    client, user, sent, f"direct/unknown link: {url}"
-                )
-            except Exception:
-                pass
-        except Exception:
-            fail += 1
-        await asyncio.sleep(0.5)
-
-    # Google Drive
-    for url in gdrive_links:
-        if user_cancelled.get(user_id):
-            break
-
-        direct_url = get_gdrive_direct_link(url)
-        if not direct_url:
-            fail += 1
-            continue
-        base_raw = direct_url.split("?", 1)[0].split("#", 1)[0]
-        base_guess = base_raw.rsplit("/", 1)[-1] or f"gdrive_{uuid.uuid4().hex}"
-        dest_path = str(temp_root / base_guess)
-        try:
-            status = await client.send_message(
-                chat_id,
-                f"Downloading from GDrive:\n{url}",
-                reply_to_message_id=reply_to,
+            basename = os.path.basename(final_path)
+            thumb_task = (
+                asyncio.create_task(choose_thumbnail(user_id, final_path))
+                if is_video_file(basename)
+                else None
             )
-            final_path = await download_file(
-                direct_url,
-                dest_path,
-                status_message=status,
-                file_name=base_guess,
-                direction="to my server",
+            await safe_edit(status, f"Uploading to you:\n{basename}")
+            await upload_media(
+                client,
+                chat_id,
+                final_path,
+                basename,
+                user=user,
+                status=status,
+                reply_to=reply_to,
+                log_note=f"{log_note}: {url}",
+                thumb_task=thumb_task,
             )
-            basename = os.path.basename(final_path)
-            await status.edit_text(f"Uploading to you:\n{basename}")
-            if is_video_path(basename):
-                base_caption = basename
-                caption = build_caption(user_id, base_caption)
-                thumb_arg = await choose_thumbnail(user_id, final_path)
-
-                start_u = time.time()
-                sent = await client.send_video(
-                    chat_id,
-                    final_path,
-                    caption=caption,
-                    thumb=thumb_arg,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, basename, "to Telegram"),
-                    reply_to_message_id=reply_to,
-                )
-            else:
-                start_u = time.time()
-                sent = await client.send_document(
-                    chat_id,
-                    final_path,
-                    caption=basename,
-                    progress=progress_for_pyrogram,
-                    progress_args=(status, start_u, basename, "to Telegram"),
-                    reply_to_message_id=reply_to,
-                )
-            try:
+            with suppress(Exception):
                 await status.delete()
-            except Exception:
-                pass
-            ok += 1
-            try:
-                await log_user_output(
-                    client, user, sent, f"GDrive link: {url}"
-                )
-            except Exception:
-                pass
-        except Exception:
-            fail += 1
-        await asyncio.sleep(0.5)
+            # link files ka koi resend button nahi: upload hote hi disk free karo,
+            # TTL cleanup tak GBs temp me pade na rahein (thumb bhi isi dir me)
+            await asyncio.to_thread(shutil.rmtree, job_dir, True)
+            return True
+
+    # m3u8 variant probes abhi se, saath-saath (aur direct downloads ke saath overlap)
+    m3u8_probes = asyncio.gather(
+        *(get_variants_cached(u) for u in m3u8_links), return_exceptions=True
+    )
 
-    # m3u8: quality menus
-    for url in m3u8_links:
-        if user_cancelled.get(user_id):
+    results = await asyncio.gather(
+        *(_fetch_and_send(*job) for job in jobs), return_exceptions=True
+    )
+    ok = sum(r is True for r in results)
+    fail = sum(r is False or isinstance(r, Exception) for r in results)
+
+    # m3u8: quality menus, link order me (probes already ho chuke)
+    for url, probe in zip(m3u8_links, await m3u8_probes):
+        if user_id in user_cancelled:
             break
-        await offer_m3u8_quality_menu(client, cq, user_id, url, temp_root)
+        await offer_m3u8_quality_menu(client, cq, user_id, url, temp_root, probe)
 
     txt = (
         f"Direct/GDrive download complete.\n"
@@ -1853,67 +2544,113 @@ async def handle_links_download_all(
         f"Failed: {fail}\n\n"
         f"m3u8 links ke liye quality choose karne ke buttons alag se bhej diye gaye hain."
     )
-    try:
-        await cq.message.edit_text(txt)
-    except MessageNotModified:
-        pass
-    except Exception:
-        pass
+    with suppress(Exception):
+        await safe_edit(cq.message, txt)
 
     if is_private and pinned:
-        try:
+        with suppress(Exception):
             await client.unpin_chat_message(chat_id, cq.message.id)
-        except Exception:
-            pass
         await client.send_message(chat_id, "All link downloads finished ✅", reply_to_message_id=reply_to)
 
 
+_SANITIZE_TABLE = str.maketrans({c: "_" for c in '\\/:*?"<>|'})
+
+
+# m3u8 url -> variants: concurrent / jaldi-jaldi repeat fetch ek hi baar
+_VARIANTS_CACHE: "TTLCache[str, List[Dict[str, str]]]" = TTLCache(maxsize=256, ttl=300)
+_VARIANTS_INFLIGHT: Dict[str, asyncio.Task] = {}
+
+
+async def get_variants_cached(url: str) -> List[Dict[str, str]]:
+    variants = _VARIANTS_CACHE.get(url)
+    if variants is not None:
+        return variants
+
+    task = _VARIANTS_INFLIGHT.get(url)
+    if task is None:
+        task = asyncio.create_task(get_m3u8_variants(url, session=get_http_session()))
+        _VARIANTS_INFLIGHT[url] = task
+        task.add_done_callback(lambda _t: _VARIANTS_INFLIGHT.pop(url, None))
+
+    variants = await asyncio.shield(task)
+    _VARIANTS_CACHE[url] = variants
+    return variants
+
+
 async def offer_m3u8_quality_menu(
-    client: Client, cq: CallbackQuery, user_id: int, url: str, temp_root: Path
+    client: Client,
+    cq: CallbackQuery,
+    user_id: int,
+    url: str,
+    temp_root: Path,
+    probe: Any = None,
 ):
+    """
+    Multiple qualities -> button menu (M3U8_TASKS entry).
+    Sirf ek quality -> koi menu/task nahi, user ko seedha "Downloading…" dikhta hai.
+    probe: caller ka pehle se gather kiya get_variants_cached result (list ya exception).
+    """
     chat_id = cq.message.chat.id
     reply_to = cq.message.id
 
-    try:
-        variants = await get_m3u8_variants(url)
-    except Exception as e:
+    if probe is None:
+        try:
+            probe = await get_variants_cached(url)
+        except Exception as e:
+            probe = e
+    if isinstance(probe, BaseException):
         await client.send_message(
             chat_id,
-            f"m3u8 parse nahi ho paya:\n<code>{e}</code>",
+            f"m3u8 parse nahi ho paya:\n<code>{probe}</code>",
             reply_to_message_id=reply_to,
         )
         return
+    variants = probe
 
-    base_raw = url.split("?", 1)[0].split("#", 1)[0]
-    base_name = base_raw.rsplit("/", 1)[-1] or "stream"
-    if base_name.endswith(".m3u8"):
-        base_name = base_name[:-6]
+    base_name = PurePosixPath(urlsplit(url).path).stem or "stream"
 
     if not variants:
         variants = [{"name": "Auto", "url": url}]
 
-    task_id = uuid.uuid4().hex
-    M3U8_TASKS[task_id] = {
-        "user_id": user_id,
-        "url": url,
-        "variants": variants,
-        "temp_root": str(temp_root),
-        "base_name": base_name,
-    }
-
-    buttons = []
-    for idx, v in enumerate(variants):
-        buttons.append(
-            [InlineKeyboardButton(v["name"], callback_data=f"m3q|{task_id}|{idx}")]
+    if len(variants) == 1:
+        # ek hi quality: menu + click skip, seedha download
+        v = variants[0]
+        status = await client.send_message(
+            chat_id,
+            f"Downloading {v['name']} stream…",
+            reply_to_message_id=reply_to,
+        )
+        # background me: baaki m3u8 links ka menu is download ka wait na kare
+        spawn(
+            download_m3u8_variant(
+                client, status, cq.from_user, v, str(temp_root), base_name, reply_to
+            )
         )
+        return
+
+    task_id = new_task_id()
+    M3U8_TASKS[task_id] = M3U8Task(
+        user_id=user_id,
+        variants=variants,
+        temp_root=str(temp_root),
+        base_name=base_name,
+    )
 
-    kb = InlineKeyboardMarkup(buttons)
+    prefix = f"m3q|{task_id}|"
+    kb = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton(v["name"], callback_data=prefix + str(idx))]
+            for idx, v in enumerate(variants)
+        ]
+    )
     await client.send_message(
         chat_id,
         f"m3u8 stream mila:\n<code>{url}</code>\n\nQuality choose karo:",
         reply_markup=kb,
         reply_to_message_id=reply_to,
     )
+    # user quality choose kare tab tak media playlists background me aa jaye
+    spawn(prefetch_media_playlists(variants, session=get_http_session()))
 
 
 async def handle_m3u8_quality_choice(
@@ -1924,76 +2661,132 @@ async def handle_m3u8_quality_choice(
         await cq.answer("Task expire ho gaya.", show_alert=True)
         return
 
-    if not cq.from_user or cq.from_user.id != info["user_id"]:
+    if not cq.from_user or cq.from_user.id != info.user_id:
         await cq.answer("Ye tumhara task nahi hai.", show_alert=True)
         return
 
-    variants = info["variants"]
+    variants = info.variants
     if index < 0 or index >= len(variants):
         await cq.answer("Invalid selection.", show_alert=True)
         return
 
     v = variants[index]
+    temp_root = info.temp_root
+    base_name = info.base_name
+    # choice ho gaya: baaki variants (+ prefetched playlists) abhi free,
+    # long download/upload ke dauran memory me na pade rahe
+    M3U8_TASKS.pop(task_id, None)
+    del info, variants
+
+    await cq.answer()
+    await safe_edit(cq.message, f"Downloading {v['name']} stream…")
+    await download_m3u8_variant(
+        client, cq.message, cq.from_user, v, temp_root, base_name, cq.message.id
+    )
+
+
+async def download_m3u8_variant(
+    client: Client,
+    status: Message,
+    user: User,
+    v: Dict[str, str],
+    temp_root: str,
+    base_name: str,
+    reply_to: int,
+):
     url = v["url"]
     name = v["name"]
-    temp_root = Path(info["temp_root"])
-    base_name = info["base_name"]
-
-    chat_id = cq.message.chat.id
-    user = cq.from_user
     user_id = user.id
-    reply_to = cq.message.id
-
-    await cq.answer()
-    await cq.message.edit_text(f"Downloading {name} stream…")
 
-    dest_path = str(temp_root / f"{base_name}_{name}.mp4")
+    # variant name playlist se aata hai: "/" waghaira se path escape na ho
+    dest_path = os.path.join(
+        temp_root, f"{base_name}_{name}.mp4".translate(_SANITIZE_TABLE)
+    )
+    # Upload poori file ke baad hi: Telegram ke big-file parts me total part
+    # count pehle chahiye, aur fragmented mp4 me duration/seek nahi milta.
+    # thumbnail stream se hi, download ke saath overlap
+    thumb_task = asyncio.create_task(
+        choose_thumbnail_from_url(user_id, url, dest_path + ".jpg")
+    )
     try:
-        await download_m3u8_stream(url, dest_path)
+        async with HEAVY_SEM:
+            await download_m3u8_stream(
+                url,
+                dest_path,
+                session=get_http_session(),
+                playlist_text=v.get("playlist_text"),
+            )
     except Exception as e:
-        await cq.message.edit_text(f"m3u8 download fail:\n<code>{e}</code>")
-        M3U8_TASKS.pop(task_id, None)
+        thumb_task.cancel()
+        await safe_edit(status, f"m3u8 download fail:\n<code>{e}</code>")
         return
 
     base_caption = f"{base_name} [{name}]"
     caption = build_caption(user_id, base_caption)
-    thumb_arg = await choose_thumbnail(user_id, dest_path)
-
-    await cq.message.edit_text("Uploading m3u8 video to you…")
-    start_u = time.time()
-    sent = await client.send_video(
-        chat_id,
-        dest_path,
-        caption=caption,
-        thumb=thumb_arg,
-        progress=progress_for_pyrogram,
-        progress_args=(cq.message, start_u, base_caption, "to Telegram"),
-        reply_to_message_id=reply_to,
+    thumb_arg = await thumb_task or await choose_thumbnail(user_id, dest_path)
+
+    await safe_edit(status, "Uploading m3u8 video to you…")
+    await UPLOAD_QUEUE.put(
+        {
+            "chat_id": status.chat.id,
+            "path": dest_path,
+            "caption": caption,
+            "thumb": thumb_arg,
+            "title": base_caption,
+            "user": user,
+            "reply_to": reply_to,
+            "status": status,
+            "log_note": f"m3u8 link: {url}",
+        }
     )
-    try:
-        await cq.message.delete()
-    except Exception:
-        pass
-    try:
-        await log_user_output(
-            client, user, sent, f"m3u8 link: {url}"
-        )
-    except Exception:
-        pass
-    M3U8_TASKS.pop(task_id, None)
 
 
 # ----------------- main (local run only; Render par server.py) -----------------
 
 
 async def main():
-    asyncio.create_task(cleanup_worker())
+    # har shard: memory-mode temp paths process-local hote hain
+    spawn(cleanup_worker())
+    if Config.SHARDS > 1:
+        spawn(shard_sync_worker())
+    await start_http_session()
+    await load_banned_ids()
     await app.start()
+    await get_log_chat_info(app)
+    start_background_tasks()
     print("Serena Unzip bot started.")
     await idle()
     await app.stop()
+    await shutdown_resources()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # optional: libuv event loop (Linux)
+
+        uvloop.install()
+    except ImportError:
+        pass
+
+    if Config.SHARDS > 1 and not USE_DB:
+        # ban/premium shards ke beech sirf DB se share hote hain
+        raise SystemExit("SHARDS > 1 ke liye MONGO_URI (shared DB) set karo.")
+
+    if Config.SHARDS > 1 and "SHARD_ID" not in os.environ:
+        # parent: har shard ek alag process (apna GIL, apna event loop)
+        procs = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__)],
+                env={**os.environ, "SHARD_ID": str(i)},
+            )
+            for i in range(Config.SHARDS)
+        ]
+        try:
+            for p in procs:
+                p.wait()
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
+    else:
+        asyncio.run(main())
 
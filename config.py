@@ -39,5 +39,25 @@ class Config:
     MAX_ARCHIVE_SIZE_FREE_MB = int(os.getenv("MAX_ARCHIVE_SIZE_FREE_MB", "2048"))  # 2 GB
     MAX_ARCHIVE_SIZE_PREMIUM_MB = int(os.getenv("MAX_ARCHIVE_SIZE_PREMIUM_MB", "10240"))  # 10 GB+
 
+    # Bot-wide ek saath chalne wale heavy downloads (link/GDrive/m3u8)
+    MAX_HEAVY_JOBS = int(os.getenv("MAX_HEAVY_JOBS", "8"))
+    # archive extract / link scan worker processes (= ek saath max extractions)
+    EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+
+    # Pyrogram session file (restart pe bot re-auth na kare) + parallel file transfers
+    SESSION_DIR = os.getenv("SESSION_DIR", "sessions")
+    MAX_CONCURRENT_TRANSMISSIONS = int(os.getenv("MAX_CONCURRENT_TRANSMISSIONS", "8"))
+    SLEEP_THRESHOLD = int(os.getenv("SLEEP_THRESHOLD", "30"))  # isse chhote FloodWait Pyrogram khud sleep kare
+
+    # Multi-process scale-out: SHARDS > 1 par har process users ka ek hissa (user_id % SHARDS) handle karta hai
+    SHARDS = int(os.getenv("SHARDS", "1"))
+    SHARD_ID = int(os.getenv("SHARD_ID", "0"))
+    SHARD_SYNC_SEC = int(os.getenv("SHARD_SYNC_SEC", "15"))  # ban/premium dusre shards se kitni der me sync
+
+    # In-memory caches
+    MAX_USER_LOCKS = int(os.getenv("MAX_USER_LOCKS", "4096"))
+    FORCE_SUB_CACHE_TTL = int(os.getenv("FORCE_SUB_CACHE_TTL", "300"))  # seconds
+    CHAT_WORKER_IDLE_SEC = int(os.getenv("CHAT_WORKER_IDLE_SEC", "60"))  # idle chat queue TTL
+
     # Misc
     DB_NAME = os.getenv("DB_NAME", "serena_unzip")
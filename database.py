@@ -1,6 +1,7 @@
 import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, AsyncIterator, Optional, Set
 
+from cachetools import TTLCache
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import PyMongoError
 
@@ -30,6 +31,16 @@ else:
 _mem_users: Dict[int, Dict[str, Any]] = {}
 _mem_files: Dict[str, Dict[str, Any]] = {}
 
+# banned ids ka set: startup pe ek baar load, set_ban se update
+_banned_ids: Set[int] = set()
+_banned_loaded = False
+# load fail hone par fallback path: per-user ban lookup ka short TTL cache
+_ban_lookup_cache: "TTLCache[int, bool]" = TTLCache(maxsize=10_000, ttl=60)
+
+# aaj ke din jin users ka get_or_create ho chuka (daily reset bhi ho gaya)
+_known_users: Set[int] = set()
+_known_day: Optional[str] = None
+
 
 def _default_user(user_id: int) -> Dict[str, Any]:
     today = datetime.date.today().isoformat()
@@ -111,6 +122,19 @@ async def get_or_create_user(user_id: int) -> Dict[str, Any]:
     return user
 
 
+async def ensure_user(user_id: int) -> None:
+    """get_or_create_user ka fast path: din me ek baar hi DB hit hota hai."""
+    global _known_day
+    today = datetime.date.today().isoformat()
+    if today != _known_day:
+        _known_users.clear()
+        _known_day = today
+    if user_id in _known_users:
+        return
+    await get_or_create_user(user_id)
+    _known_users.add(user_id)
+
+
 async def update_user_stats(user_id: int, size_mb: float):
     # in‑memory
     user = _mem_users.get(user_id)
@@ -160,6 +184,11 @@ async def set_ban(user_id: int, value: bool = True):
     user = _mem_users.get(user_id) or _default_user(user_id)
     user["is_banned"] = value
     _mem_users[user_id] = user
+    if value:
+        _banned_ids.add(user_id)
+    else:
+        _banned_ids.discard(user_id)
+    _ban_lookup_cache[user_id] = value
 
     if USE_DB:
         await _safe_db(
@@ -171,12 +200,72 @@ async def set_ban(user_id: int, value: bool = True):
         )
 
 
+async def load_banned_ids():
+    """
+    Startup pe banned users ek baar load karo; uske baad is_banned DB hit nahi karta.
+    """
+    global _banned_loaded
+    if USE_DB:
+        try:
+            async for doc in users_col.find({"is_banned": True}, {"_id": 1}):
+                _banned_ids.add(doc["_id"])
+        except Exception:
+            return  # load fail -> purana per-user lookup path chalega
+    _banned_loaded = True
+
+
+async def reload_banned_ids():
+    """
+    Multi-shard: dusre process ka /ban /unban sirf DB me dikhta hai;
+    poora set dobara padho (unban bhi pakda jaye).
+    """
+    if not USE_DB:
+        return
+    fresh: Set[int] = set()
+    async for doc in users_col.find({"is_banned": True}, {"_id": 1}):
+        fresh.add(doc["_id"])
+    _banned_ids.clear()
+    _banned_ids.update(fresh)
+
+
+async def set_premium_until(user_id: int, until: float):
+    """Premium expiry (unix ts) DB me, taaki saare shards / restart ko dikhe."""
+    if USE_DB:
+        await _safe_db(
+            users_col.update_one(
+                {"_id": user_id},
+                {"$set": {"is_premium": True, "premium_until": until}},
+                upsert=True,
+            )
+        )
+
+
+async def load_premium_until(now: float) -> Dict[int, float]:
+    """Abhi active premium users: user_id -> expiry ts."""
+    if not USE_DB:
+        return {}
+    out: Dict[int, float] = {}
+    async for doc in users_col.find(
+        {"premium_until": {"$gt": now}}, {"_id": 1, "premium_until": 1}
+    ):
+        out[doc["_id"]] = doc["premium_until"]
+    return out
+
+
 async def is_banned(user_id: int) -> bool:
+    if _banned_loaded:
+        return user_id in _banned_ids
+
     # memory first
     user = _mem_users.get(user_id)
     if user is not None:
         return bool(user.get("is_banned", False))
 
+    cached = _ban_lookup_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    banned = False
     if USE_DB:
         doc = await _safe_db(
             users_col.find_one({"_id": user_id}, {"is_banned": 1}),
@@ -185,9 +274,9 @@ async def is_banned(user_id: int) -> bool:
         if doc is not None:
             # cache in memory
             _mem_users[user_id] = doc
-            return bool(doc.get("is_banned", False))
-
-    return False
+            banned = bool(doc.get("is_banned", False))
+    _ban_lookup_cache[user_id] = banned
+    return banned
 
 
 async def get_all_users():
@@ -206,6 +295,27 @@ async def get_all_users():
     return list(_mem_users.keys())
 
 
+async def get_all_users_iter() -> AsyncIterator[int]:
+    """
+    User ids ko stream karta hai (poori list memory me load kiye bina).
+    DB off ho ya shuru me hi fail ho jaye to memory fallback.
+    """
+    if USE_DB:
+        yielded = False
+        try:
+            async for doc in users_col.find({}, {"_id": 1}):
+                yielded = True
+                yield doc["_id"]
+            return
+        except Exception:
+            if yielded:
+                return
+
+    # fallback to memory only
+    for uid in list(_mem_users.keys()):
+        yield uid
+
+
 async def count_users():
     if USE_DB:
         total = await _safe_db(users_col.count_documents({}), default=0) or 0
@@ -1,5 +1,4 @@
 # server.py
-import asyncio
 import sys
 from pathlib import Path
 
@@ -13,6 +12,15 @@ if str(BASE_DIR) not in sys.path:
 
 # Ab yaha se bot import karega
 from bot import app as tg_app  # pyrogram Client
+from bot import (
+    start_http_session,
+    shutdown_resources,
+    get_log_chat_info,
+    start_background_tasks,
+    spawn,
+)
+from config import Config
+from database import load_banned_ids
 from utils.cleanup import cleanup_worker
 
 
@@ -21,11 +29,21 @@ fastapi_app = FastAPI(title="Serena Unzip Web Service")
 
 @fastapi_app.on_event("startup")
 async def on_startup():
+    # web-service mode ek hi process hai: shard gate baaki users ke updates gira dega
+    if Config.SHARDS > 1:
+        raise RuntimeError("SHARDS > 1 sirf `python bot.py` launcher ke saath chalta hai.")
+
     # background cleanup worker
-    asyncio.create_task(cleanup_worker())
+    spawn(cleanup_worker())
+
+    # shared aiohttp pool for link downloads
+    await start_http_session()
+    await load_banned_ids()
 
     # start Telegram bot client
     await tg_app.start()
+    await get_log_chat_info(tg_app)
+    start_background_tasks()
     print("Serena Unzip bot started (web service mode)")
 
 
@@ -33,6 +51,7 @@ async def on_startup():
 async def on_shutdown():
     # stop Telegram bot client
     await tg_app.stop()
+    await shutdown_resources()
     print("Serena Unzip bot stopped")
 
 
@@ -0,0 +1,36 @@
+import pytest
+
+m3u8 = pytest.importorskip("m3u8")
+pytest.importorskip("aiohttp")
+
+from utils.m3u8_tools import _can_fetch_segments  # noqa: E402
+
+PLAIN = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:10
+#EXTINF:10.0,
+seg0.ts
+#EXTINF:10.0,
+seg1.ts
+#EXT-X-ENDLIST
+"""
+
+BYTERANGE = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-TARGETDURATION:10
+#EXTINF:10.0,
+#EXT-X-BYTERANGE:75232@0
+video.ts
+#EXTINF:10.0,
+#EXT-X-BYTERANGE:82112@75232
+video.ts
+#EXT-X-ENDLIST
+"""
+
+
+def test_plain_ts_playlist_fetches_segments():
+    assert _can_fetch_segments(m3u8.loads(PLAIN, uri="https://cdn.test/a.m3u8"))
+
+
+def test_byterange_playlist_falls_back_to_ffmpeg():
+    assert not _can_fetch_segments(m3u8.loads(BYTERANGE, uri="https://cdn.test/a.m3u8"))
@@ -35,9 +35,9 @@ def _scan_stats(base_dir: Path) -> Dict[str, Any]:
 
         for f in fls:
             stats["total_files"] += 1
-            p = Path(root) / f
-            rel_path = os.path.relpath(p, base_dir)
-            ext = p.suffix.lower()
+            # har file pe Path() + relpath ki jagah seedha join
+            rel_path = f if rel_root == "." else os.path.join(rel_root, f)
+            ext = os.path.splitext(f)[1].lower()
 
             if ext in VIDEO_EXT:
                 stats["videos"] += 1
@@ -54,6 +54,8 @@ def _scan_stats(base_dir: Path) -> Dict[str, Any]:
 
             files.append(rel_path)
 
+    # sort bhi worker process me hi, bot ka event loop N log N se bache
+    files.sort(key=str.lower)
     return {"stats": stats, "files": files}
 
 
@@ -149,7 +151,7 @@ def extract_archive(
     """
     Extracts archive to dest_dir.
     Supports: zip, rar, 7z, tar, tar.gz, tgz, tar.bz2, tbz2, gz, bz2
-    Returns: { "stats": {...}, "files": [relative paths] }
+    Returns: { "stats": {...}, "files": [relative paths, case-insensitive sorted] }
     """
     Path(dest_dir).mkdir(parents=True, exist_ok=True)
     t = _archive_type(archive_path)
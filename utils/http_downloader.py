@@ -41,18 +41,26 @@ async def download_file(
     status_message: Optional[Message] = None,
     file_name: Optional[str] = None,
     direction: str = "from web",
+    session: Optional[aiohttp.ClientSession] = None,
 ) -> str:
     """
     HTTP downloader with optional Telegram-style progress bar.
+    Shared `session` pass karo to connections (TCP/TLS) reuse hote hain;
+    na diya to ek temporary session bana ke close kar dega.
 
     Returns: final saved file path (with proper filename if server sends it).
     """
     dest_dir = os.path.dirname(dest_path) or "."
     os.makedirs(dest_dir, exist_ok=True)
 
-    timeout_cfg = aiohttp.ClientTimeout(total=timeout)
-    async with aiohttp.ClientSession(timeout=timeout_cfg) as session:
-        async with session.get(url) as resp:
+    # per-request timeout session wala replace karta hai, isliye sock_* yahan bhi
+    timeout_cfg = aiohttp.ClientTimeout(total=timeout, sock_connect=15, sock_read=60)
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(timeout=timeout_cfg)
+
+    try:
+        async with session.get(url, timeout=timeout_cfg) as resp:
             resp.raise_for_status()
             total = int(resp.headers.get("Content-Length") or 0)
             cd = resp.headers.get("Content-Disposition", "")
@@ -74,6 +82,8 @@ async def download_file(
 
             downloaded = 0
             start = time.time()
+            last_cb = 0.0
+            show_progress = status_message is not None and total > 0
 
             with open(final_path, "wb") as f:
                 async for chunk in resp.content.iter_chunked(chunk_size):
@@ -82,7 +92,13 @@ async def download_file(
                     f.write(chunk)
                     downloaded += len(chunk)
 
-                    if status_message and total > 0:
+                    # 64 KiB chunks: har chunk pe coroutine call ki jagah ~1/s
+                    # (edit throttle progress_for_pyrogram khud karta hai)
+                    if show_progress:
+                        now = time.time()
+                        if now - last_cb < 1.0:
+                            continue
+                        last_cb = now
                         await progress_for_pyrogram(
                             downloaded,
                             total,
@@ -93,7 +109,7 @@ async def download_file(
                         )
 
             # final 100% update agar total > 0
-            if status_message and total > 0 and downloaded == total:
+            if show_progress and downloaded == total:
                 await progress_for_pyrogram(
                     downloaded,
                     total,
@@ -102,5 +118,8 @@ async def download_file(
                     fname,
                     direction,
                 )
+    finally:
+        if own_session:
+            await session.close()
 
     return final_path
@@ -1,11 +1,12 @@
 # utils/link_parser.py
 import os
 import re
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Dict
 
 URL_REGEX = re.compile(
-    r"(https?://[^\s]+)",
+    r"(https?://[^\s<>\"']+)",
     re.IGNORECASE
 )
 
@@ -23,12 +24,19 @@ APK_EXT = {
 }
 
 FILE_EXT = VIDEO_EXT | ARCHIVE_EXT | AUDIO_EXT | APK_EXT
+# str.endswith tuple leta hai: saare suffix ek hi C call me
+_FILE_EXT_TUPLE = tuple(FILE_EXT)
 
 
 def find_links_in_text(text: str) -> List[str]:
-    return [m.group(1).strip().strip(".,)") for m in URL_REGEX.finditer(text)]
+    # zyada tar messages me link hota hi nahi: C-level substring check se turant bahar
+    if "://" not in text:
+        return []
+    # match me whitespace aa hi nahi sakta aur shuru "http" se hota hai -> sirf rstrip
+    return [u.rstrip(".,)") for u in URL_REGEX.findall(text)]
 
 
+@lru_cache(maxsize=4096)
 def classify_link(url: str) -> str:
     """
     Return: 'gdrive' | 'telegram' | 'm3u8' | 'direct' | 'unknown'
@@ -47,9 +55,8 @@ def classify_link(url: str) -> str:
     if base.endswith(".m3u8"):
         return "m3u8"
 
-    for ext in FILE_EXT:
-        if base.endswith(ext):
-            return "direct"
+    if base.endswith(_FILE_EXT_TUPLE):
+        return "direct"
 
     return "unknown"
 
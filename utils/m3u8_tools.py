@@ -1,31 +1,78 @@
 # utils/m3u8_tools.py
+import asyncio
+import re
+from collections import deque
+from contextlib import suppress
+from typing import Deque, List, Dict, Optional
+from urllib.parse import urljoin
+
 import aiohttp
 import m3u8
-from typing import List, Dict
 
-from utils.media_tools import run_ffmpeg
+from utils.media_tools import FFmpegError, run_ffmpeg
+
+# ek stream ke kitne .ts segments ek saath fetch honge
+SEGMENT_CONCURRENCY = 8
+SEGMENT_RETRIES = 3
+
+# master playlist: STREAM-INF tag + uske baad wali pehli URI line
+_STREAM_INF_RE = re.compile(
+    r"^#EXT-X-STREAM-INF:([^\r\n]*)\r?\n(?:[ \t]*\r?\n|#[^\r\n]*\r?\n)*([^#\s][^\r\n]*)",
+    re.MULTILINE,
+)
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
 
 
-async def _fetch_m3u8(url: str) -> m3u8.M3U8:
+async def _fetch_text(
+    url: str,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> str:
     """
-    Fetch m3u8 content asynchronously and parse with m3u8 lib.
+    Playlist body fetch karta hai.
+    Shared session mile to wahi use hota hai (keep-alive reuse).
     """
-    async with aiohttp.ClientSession() as session:
+    if session is not None:
         async with session.get(url) as resp:
             resp.raise_for_status()
-            text = await resp.text()
+            return await resp.text()
+    async with aiohttp.ClientSession() as own:
+        async with own.get(url) as resp:
+            resp.raise_for_status()
+            return await resp.text()
+
+
+async def _fetch_m3u8(
+    url: str,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> m3u8.M3U8:
+    """
+    Fetch m3u8 content asynchronously and parse with m3u8 lib.
+    """
+    text = await _fetch_text(url, session=session)
     # uri param: base url for relative playlist/segment urls
     return m3u8.loads(text, uri=url)
 
 
-async def get_m3u8_variants(url: str) -> List[Dict[str, str]]:
+async def get_m3u8_variants(
+    url: str,
+    session: Optional[aiohttp.ClientSession] = None,
+) -> List[Dict[str, str]]:
     """
     Returns list of variants:
     [ { "name": "360p", "url": "http://..." }, ... ]
     If no variants (simple playlist): returns one entry Auto.
     """
-    playlist = await _fetch_m3u8(url)
-    variants: List[Dict[str, str]] = []
+    text = await _fetch_text(url, session=session)
+    if "#EXT-X-STREAM-INF" not in text:
+        # simple playlist: body already haath me hai, dobara fetch nahi
+        return [{"name": "Auto", "url": url, "playlist_text": text}]
+
+    variants = parse_master(text, url)
+    if variants:
+        return variants
+
+    # regex se kuch nahi mila (ajeeb formatting): m3u8 lib fallback
+    playlist = m3u8.loads(text, uri=url)
 
     if playlist.playlists:  # master playlist with multiple qualities
         for pl in playlist.playlists:
@@ -47,16 +94,171 @@ async def get_m3u8_variants(url: str) -> List[Dict[str, str]]:
             {
                 "name": "Auto",
                 "url": url,
+                "playlist_text": text,
             }
         )
 
     return variants
 
 
-async def download_m3u8_stream(src_url: str, dest_path: str):
+def parse_master(text: str, base_url: str) -> List[Dict[str, str]]:
+    """
+    Master playlist ka one-pass regex scan (m3u8 lib ke per-line parse ki jagah).
+    Naming wahi: RESOLUTION -> "720p", warna BANDWIDTH -> "2500kbps".
+    """
+    variants: List[Dict[str, str]] = []
+    for m in _STREAM_INF_RE.finditer(text):
+        attrs = {k: v.strip('"') for k, v in _ATTR_RE.findall(m.group(1))}
+        name = "Variant"
+        res = attrs.get("RESOLUTION", "")
+        if "x" in res:
+            name = f"{res.partition('x')[2]}p"
+        elif attrs.get("BANDWIDTH", "").isdigit():
+            name = f"{int(attrs['BANDWIDTH']) // 1000}kbps"
+        variants.append(
+            {
+                "name": name,
+                "url": urljoin(base_url, m.group(2).strip()),
+            }
+        )
+    return variants
+
+
+async def prefetch_media_playlists(
+    variants: List[Dict[str, str]],
+    session: Optional[aiohttp.ClientSession] = None,
+):
+    """
+    Har variant ki media playlist pehle se le aata hai (v["playlist_text"]),
+    taaki quality click ke baad ek RTT bach jaye. Fail hua to skip.
+    """
+    todo = [v for v in variants if "playlist_text" not in v]
+    results = await asyncio.gather(
+        *(_fetch_text(v["url"], session=session) for v in todo),
+        return_exceptions=True,
+    )
+    for v, res in zip(todo, results):
+        if isinstance(res, str):
+            v["playlist_text"] = res
+
+
+def _can_fetch_segments(playlist: m3u8.M3U8) -> bool:
+    """
+    Plain .ts media playlist hai to hi khud segments fetch karte hain.
+    Encrypted (EXT-X-KEY), fMP4 (EXT-X-MAP), byterange (EXT-X-BYTERANGE)
+    ya master playlist ffmpeg sambhalega.
+    """
+    if playlist.is_variant or not playlist.segments:
+        return False
+    if playlist.segment_map:
+        return False
+    # byterange: sab segments ek hi URI ke tukde; poori file N baar GET ho jayegi
+    if any(s.byterange for s in playlist.segments):
+        return False
+    return not any(k and k.method and k.method.upper() != "NONE" for k in playlist.keys)
+
+
+async def _fetch_segment(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    url: str,
+) -> bytes:
+    async with sem:
+        for attempt in range(SEGMENT_RETRIES):
+            try:
+                async with session.get(url) as resp:
+                    resp.raise_for_status()
+                    return await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == SEGMENT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(1 + attempt)
+
+
+async def _download_segments(
+    playlist: m3u8.M3U8,
+    dest_path: str,
+    session: aiohttp.ClientSession,
+    concurrency: int,
+):
     """
-    Download m3u8 stream using ffmpeg; container as mp4.
+    Segments parallel fetch hote hain par ffmpeg stdin me order me jaate hain
+    (.ts byte-concat valid mpegts hai). Beech me koi .parts file disk pe nahi.
+    Window 2x concurrency: ek slow segment pe RAM me zyada data jama na ho.
     """
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y",
+        "-f", "mpegts",
+        "-i", "pipe:0",
+        "-c", "copy",
+        dest_path,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    err_task = asyncio.create_task(proc.stderr.read())
+    sem = asyncio.Semaphore(concurrency)
+    pending: Deque[asyncio.Task] = deque()
+
+    async def _write_next():
+        data = await pending.popleft()
+        proc.stdin.write(data)
+        await proc.stdin.drain()
+
+    try:
+        for seg in playlist.segments:
+            pending.append(
+                asyncio.create_task(_fetch_segment(session, sem, seg.absolute_uri))
+            )
+            if len(pending) >= concurrency * 2:
+                await _write_next()
+        while pending:
+            await _write_next()
+        proc.stdin.close()
+    except BaseException:
+        for t in pending:
+            t.cancel()
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        err_task.cancel()
+        raise
+
+    err = await err_task
+    if await proc.wait() != 0:
+        raise FFmpegError(err.decode(errors="ignore"))
+
+
+async def download_m3u8_stream(
+    src_url: str,
+    dest_path: str,
+    session: Optional[aiohttp.ClientSession] = None,
+    concurrency: int = SEGMENT_CONCURRENCY,
+    playlist_text: Optional[str] = None,
+):
+    """
+    Download m3u8 stream; container as mp4.
+    Segments aiohttp se parallel aate hain aur pipe se ffmpeg me remux
+    (sirf -c copy). Jo playlist hum khud nahi pad sakte wo seedha ffmpeg ko.
+    `playlist_text` (prefetched body) diya to playlist dobara fetch nahi hoti.
+    """
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16, limit_per_host=8)
+        )
+    try:
+        if playlist_text is not None:
+            playlist = m3u8.loads(playlist_text, uri=src_url)
+        else:
+            playlist = await _fetch_m3u8(src_url, session=session)
+        if _can_fetch_segments(playlist):
+            await _download_segments(playlist, dest_path, session, concurrency)
+            return
+    finally:
+        if own_session:
+            await session.close()
+
     cmd = [
         "ffmpeg",
         "-y",
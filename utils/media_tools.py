@@ -1,8 +1,20 @@
 # utils/media_tools.py
 import asyncio
 import os
+from contextlib import suppress
 from typing import List
 
+try:
+    # optional: in-process keyframe decode + resize (ffmpeg process spawn nahi)
+    import av
+    from PIL import Image
+except ImportError:
+    av = None
+    Image = None
+
+# Telegram thumbnail: max 320x320 JPEG
+THUMB_MAX_SIZE = (320, 320)
+
 
 class FFmpegError(RuntimeError):
     pass
@@ -14,7 +26,14 @@ async def run_ffmpeg(cmd: list):
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
-    out, err = await proc.communicate()
+    try:
+        out, err = await proc.communicate()
+    except asyncio.CancelledError:
+        # caller ne cancel kiya (e.g. remote thumb task): ffmpeg orphan na chhode
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+        raise
     if proc.returncode != 0:
         raise FFmpegError(err.decode(errors="ignore"))
 
@@ -65,21 +84,56 @@ async def split_video(video_path: str, start: str, duration: str, output_path: s
     await run_ffmpeg(cmd)
 
 
+def _hms_to_sec(time_pos: str) -> float:
+    sec = 0.0
+    for part in time_pos.split(":"):
+        sec = sec * 60 + float(part)
+    return sec
+
+
+def _thumb_with_av(video_path: str, thumb_path: str, seek_sec: float) -> str:
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"  # sirf keyframes decode
+        if seek_sec > 0:
+            container.seek(int(seek_sec / stream.time_base), stream=stream)
+        img = None
+        for frame in container.decode(stream):
+            img = frame.to_image()
+            break
+    if img is None:
+        raise FFmpegError("video frame nahi mila")
+    img.thumbnail(THUMB_MAX_SIZE, Image.LANCZOS)
+    img.save(thumb_path, "JPEG", quality=75, optimize=True)
+    return thumb_path
+
+
 async def generate_thumbnail(
     video_path: str,
     thumb_path: str,
     time_pos: str = "00:00:02",
 ):
     """
-    Thumbnail generate karega video se:
-    ffmpeg -ss time_pos -i video -vframes 1 -q:v 2 thumb.jpg
+    Thumbnail generate karega video se (max 320x320 JPEG).
+    Local file + PyAV/Pillow available -> thread me keyframe decode;
+    warna / fail hua to:
+    ffmpeg -ss time_pos -i video -vframes 1 -vf scale(320 box) -q:v 2 thumb.jpg
     """
+    if av is not None and "://" not in video_path:
+        try:
+            return await asyncio.to_thread(
+                _thumb_with_av, video_path, thumb_path, _hms_to_sec(time_pos)
+            )
+        except Exception:
+            pass
+
     cmd = [
         "ffmpeg",
         "-y",
         "-ss", time_pos,
         "-i", video_path,
         "-vframes", "1",
+        "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
         "-q:v", "2",
         thumb_path,
     ]
@@ -1,12 +1,20 @@
 # utils/progress.py
+import asyncio
 import time
-from typing import Dict
+from contextlib import suppress
+from typing import Dict, Optional, Tuple
 
-from pyrogram.types import Message
+from cachetools import LRUCache
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.types import InlineKeyboardMarkup, Message
 
 from config import Config
 
-_last_update: Dict[int, float] = {}  # msg_id -> timestamp
+# key = (chat_id, msg_id): msg ids sirf chat ke andar unique hote hain
+_last_update: Dict[Tuple[int, int], float] = {}  # -> last edit timestamp
+_inflight: Dict[Tuple[int, int], asyncio.Task] = {}  # -> chal rahi edit task
+# -> last text jo safe_edit ne set kiya; same text pe RPC hi nahi
+_last_text: "LRUCache[Tuple[int, int], str]" = LRUCache(maxsize=4096)
 
 
 def human_bytes(size: int) -> str:
@@ -47,10 +55,15 @@ async def progress_for_pyrogram(
     NOTE: start_time = time.time() hona chahiye. (bot.py me fix kiya gaya hai)
     """
     now = time.time()
-    msg_id = message.id
-    last = _last_update.get(msg_id, 0)
-    if now - last < Config.PROGRESS_UPDATE_INTERVAL and current != total:
-        return
+    msg_id = (message.chat.id, message.id)
+    done = current == total
+    if not done:
+        last = _last_update.get(msg_id, 0)
+        if now - last < Config.PROGRESS_UPDATE_INTERVAL:
+            return
+        # pichla edit abhi chal raha hai: naya tick coalesce (skip)
+        if msg_id in _inflight:
+            return
 
     _last_update[msg_id] = now
 
@@ -77,10 +90,71 @@ async def progress_for_pyrogram(
         f"◌Time Left⏳:〘 {human_time(eta)} 〙"
     )
 
+    # edit background me: upload loop edit ke RTT / FloodWait pe nahi rukta.
+    # final 100% tick drop nahi hota: chal rahe edit ke peeche chain ho jata hai
+    prev = _inflight.get(msg_id) if done else None
+    _inflight[msg_id] = asyncio.create_task(
+        _edit_progress(message, text, prev=prev, final=done)
+    )
+
+
+async def settle_progress(message: Message):
+    """
+    Status msg ko naya text dene se pehle call karo: background me chal raha
+    progress edit pehle land ho jaye, baad me aake naye text ko overwrite na kare.
+    """
+    msg_id = (message.chat.id, message.id)
+    task = _inflight.get(msg_id)
+    if task is not None:
+        with suppress(Exception):
+            await task
+    _last_update.pop(msg_id, None)
+
+
+async def safe_edit(
+    message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None
+):
+    """
+    Status msg edit: pehle pending progress settle, phir same text ho to skip.
+    Message ke saare text edits isi se karo, warna cache stale ho jata hai.
+    """
+    # pending progress edit pehle land ho, warna wo is text ko overwrite kar dega
+    await settle_progress(message)
+    key = (message.chat.id, message.id)
+    # keyboard badal sakta hai, isliye reply_markup ke saath kabhi skip nahi
+    if reply_markup is None and _last_text.get(key) == text:
+        return
     try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except MessageNotModified:
+        pass
+    _last_text[key] = text
+
+
+async def _edit_progress(
+    message: Message,
+    text: str,
+    prev: Optional[asyncio.Task] = None,
+    final: bool = False,
+):
+    msg_id = (message.chat.id, message.id)
+    try:
+        if prev is not None:
+            with suppress(Exception):
+                await prev
+        # text badal raha hai: safe_edit ka cache ab galat hai
+        _last_text.pop(msg_id, None)
         await message.edit_text(text)
+    except FloodWait as e:
+        # wait khatam hone tak is msg ke ticks skip
+        if not final:
+            _last_update[msg_id] = time.time() + e.value
     except Exception:
         pass
-
-    if current == total and msg_id in _last_update:
-        _last_update.pop(msg_id, None)
+    finally:
+        # sirf apni entry hatao (final task ne replace kar di ho to wo rahe)
+        if _inflight.get(msg_id) is asyncio.current_task():
+            _inflight.pop(msg_id, None)
+        if final:
+            # transfer khatam: throttle state bhi hatao, dict na badhe
+            _last_update.pop(msg_id, None)
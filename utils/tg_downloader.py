@@ -0,0 +1,72 @@
+# utils/tg_downloader.py
+import asyncio
+import os
+from contextlib import suppress
+from typing import Any, Callable, Optional, Tuple
+
+from pyrogram import Client
+
+# Telegram chunks (~1 MiB) ko itna jama karke ek write(2) karte hain (slab size)
+WRITE_BATCH = 8 * 1024 * 1024
+
+
+async def download_tg_file(
+    client: Client,
+    media: Any,
+    dest_path: str,
+    progress: Optional[Callable] = None,
+    progress_args: Tuple = (),
+) -> str:
+    """
+    Telegram file ko disk pe download karta hai (client.download_media ki jagah).
+    Pyrogram ka default sink har chunk pe event loop thread se hi write karta hai;
+    yaha chunks batch hote hain aur write thread me hota hai.
+
+    Returns: dest_path
+    """
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    total = getattr(media, "file_size", 0) or 0
+
+    f = await asyncio.to_thread(open, dest_path, "wb")
+    # 2 fixed slabs (double buffer): ek disk pe likh raha, doosra bhar raha.
+    # har batch pe naya bytearray allocate nahi hota.
+    slabs = [bytearray(WRITE_BATCH), bytearray(WRITE_BATCH)]
+    cur = 0
+    pos = 0
+    pending: Optional[asyncio.Future] = None
+    try:
+        done = 0
+        async for chunk in client.stream_media(media):
+            n = len(chunk)
+            if pos + n > WRITE_BATCH:
+                if pending is not None:
+                    await pending
+                pending = asyncio.ensure_future(
+                    asyncio.to_thread(f.write, memoryview(slabs[cur])[:pos])
+                )
+                cur ^= 1
+                pos = 0
+            if n > WRITE_BATCH:
+                # slab se bada chunk (practically nahi hota): seedha likh do
+                if pending is not None:
+                    await pending
+                    pending = None
+                await asyncio.to_thread(f.write, chunk)
+            else:
+                slabs[cur][pos:pos + n] = chunk
+                pos += n
+            done += n
+            if progress:
+                await progress(done, total, *progress_args)
+        if pending is not None:
+            await pending
+            pending = None
+        if pos:
+            await asyncio.to_thread(f.write, memoryview(slabs[cur])[:pos])
+    finally:
+        if pending is not None:
+            with suppress(Exception):
+                await pending
+        await asyncio.to_thread(f.close)
+
+    return dest_path